@@ -34,10 +34,11 @@ SOFTWARE.
 import os
 import os.path as op
 import sys
+import logging
 import argparse
-import subprocess
 from importlib.metadata import version
-from glob import glob
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from . import io as bio
 from . import translate as btr
@@ -103,8 +104,14 @@ def main():
     )
 
     parser.add_argument(
-        '--compression', required=False, default='o',
-        help='gzip compression flag for dcm2niix (y, o, i, n, 3 depending on dcm2niix version) [o]'
+        '--only-protocol', action='append', default=[], metavar='SERDESC',
+        help='Pass 2 only: reconvert only DICOM series with this series description (repeatable)'
+    )
+
+    parser.add_argument(
+        '--compression', required=False, default=None,
+        help='gzip compression flag for dcm2niix (y, o, i, n, 3 depending on dcm2niix version)'
+             ' or one of pigz, piped, internal, none [o, or i for parallel jobs or a single CPU]'
     )
 
     parser.add_argument(
@@ -132,6 +139,21 @@ def main():
         help='Curate Flywheel DICOM zip archives in top level of BIDS folder'
     )
 
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of dcm2niix conversions to run in parallel [1]'
+    )
+
+    parser.add_argument(
+        '-v', '--verbose', action='store_true', default=False,
+        help='Report every file copied or written to the BIDS directory'
+    )
+
+    parser.add_argument(
+        '-q', '--quiet', action='store_true', default=False,
+        help='Suppress per-series progress messages (warnings and overall progress are still shown)'
+    )
+
     parser.add_argument(
         '-V', '--version', action='store_true', default=False,
         help='Display bidskit version number and exit'
@@ -147,8 +169,26 @@ def main():
     ignore = args.ignore
     overwrite = args.overwrite
     bind_fmaps = args.bind_fmaps
-    gzip_type = args.compression.lower()
     auto = args.auto
+    n_jobs = max(1, args.jobs)
+
+    # Series descriptions to reconvert, matching translator keys (spaces replaced with underscores)
+    only_protocols = {ser_desc.replace(' ', '_') for ser_desc in args.only_protocol}
+
+    # CPUs available to this process (respects cgroup/taskset affinity on Linux)
+    try:
+        n_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n_cpus = os.cpu_count() or 1
+
+    # Default to multithreaded pigz compression for a single conversion job
+    # Parallel jobs and single CPU nodes use dcm2niix internal compression
+    # to avoid oversubscribing cores with pigz threads
+    if args.compression:
+        gzip_type = args.compression.lower()
+        gzip_type = {'pigz': 'y', 'piped': 'o', 'internal': 'i', 'none': 'n'}.get(gzip_type, gzip_type)
+    else:
+        gzip_type = 'i' if n_jobs > 1 or n_cpus < 2 else 'o'
 
     # Set Nifti image extension from gzip type
     nii_ext = ".nii" if 'n' in gzip_type else ".nii.gz"
@@ -160,6 +200,22 @@ def main():
         'Recon': args.recon
     }
 
+    # Per-series progress messages from bidskit modules are logged at INFO level
+    # and per-file messages at DEBUG level
+    # Only attach the stdout handler once and keep messages out of any root logging configuration
+    logger = logging.getLogger('bidskit')
+    if not logger.handlers:
+        log_handler = logging.StreamHandler(sys.stdout)
+        log_handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(log_handler)
+    logger.propagate = False
+    if args.quiet:
+        logger.setLevel(logging.WARNING)
+    elif args.verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
     # Read installed version number
     ver = version('bidskit')
 
@@ -206,6 +262,7 @@ def main():
     print(f"Auto translate             : {'Yes' if auto else 'No'}")
     print(f"Bind fieldmaps             : {'Yes' if bind_fmaps else 'No'}")
     print(f"GZIP compression           : {gzip_type}")
+    print(f"Parallel conversion jobs   : {n_jobs}")
     print(f"Recon filename key         : {key_flags['Recon']}")
     print(f"Part filename key          : {key_flags['Part']}")
     print(f"Echo filename key          : {key_flags['Echo']}")
@@ -238,18 +295,21 @@ def main():
     # Init list of source subject directories from sourcedata contents if no subjects provided in command line
     if len(subject_list) < 1:
         print('  Creating subject list from sourcedata contents')
-        subject_list = []
-        for it in os.scandir(btree.sourcedata_dir):
-            if it.is_dir():
-                subject_list.append(it.name)
+        with os.scandir(btree.sourcedata_dir) as it:
+            subject_list = sorted(entry.name for entry in it
+                                  if entry.is_dir() and not entry.name.startswith('.'))
         print('  Found {:d} subjects in sourcedata folder'.format(len(subject_list)))
 
+    # List of (subject, session) conversions to organize and DICOM folders needing dcm2niix conversion
+    session_list_all = []
+    conv_jobs = []
+
     # Loop over subject list (either from sourcedata contents or command line)
     for sid in subject_list:
 
         print('')
         print('------------------------------------------------------------')
-        print('Processing subject {}'.format(sid))
+        print('Preparing subject {}'.format(sid))
         print('------------------------------------------------------------')
 
         # Full path to subject directory in sourcedata/
@@ -275,7 +335,9 @@ def main():
                 dcm_dir_list = [op.join(src_subj_dir, sid) for sid in session_list]
             else:
                 # Get list of DICOM session-level folders for this subject
-                dcm_dir_list = sorted(glob(op.join(src_subj_dir, '*')))
+                with os.scandir(src_subj_dir) as it:
+                    dcm_dir_list = sorted(entry.path for entry in it
+                                          if entry.is_dir() and not entry.name.startswith('.'))
 
         # Loop over DICOM directories in subject directory
         for dcm_dir in dcm_dir_list:
@@ -293,7 +355,7 @@ def main():
                 ses_clean = ses.replace('-', '').replace('_', '')
 
                 ses_prefix = f'ses-{ses_clean:s}'
-                print(f'\n  Processing session {ses}')
+                print(f'\n  Preparing session {ses}')
 
             # Working conversion directories
             work_subj_dir = op.join(btree.work_dir, subj_prefix)
@@ -303,12 +365,12 @@ def main():
             bids_subj_dir = op.join(dataset_dir, subj_prefix)
             bids_ses_dir = op.join(bids_subj_dir, ses_prefix)
 
-            print('  Working subject directory : %s' % work_subj_dir)
+            print(f'  Working subject directory : {work_subj_dir}')
             if not no_sessions:
-                print('  Working session directory : %s' % work_conv_dir)
-            print('  BIDS subject directory  : %s' % bids_subj_dir)
+                print(f'  Working session directory : {work_conv_dir}')
+            print(f'  BIDS subject directory  : {bids_subj_dir}')
             if not no_sessions:
-                print('  BIDS session directory  : %s' % bids_ses_dir)
+                print(f'  BIDS session directory  : {bids_ses_dir}')
 
             # Safely create working directory for current subject
             # Flag for conversion if no working directory exists
@@ -319,38 +381,67 @@ def main():
                 needs_converting = False
 
             if first_pass or needs_converting:
+                conv_jobs.append((dcm_dir, work_conv_dir, None))
+            elif only_protocols:
+                # Reconvert selected series only (eg following translator edits)
+                conv_jobs.append((dcm_dir, work_conv_dir, only_protocols))
+
+            session_list_all.append((sid, sid_clean, ses_clean, dcm_dir, work_conv_dir, bids_ses_dir))
 
-                # Run dcm2niix conversion into working conversion directory
-                print('  Converting all DICOM images in %s' % dcm_dir)
+    # BIDS anonymization flag - default 'y'
+    anon = 'n' if no_anon else 'y'
 
-                # BIDS anonymization flag - default 'y'
-                anon = 'n' if no_anon else 'y'
+    # dcm2niix flag for ignoring derived (e.g, dwi FA, TRACEW, etc),
+    # localizer and 2D images
+    do_ignore = 'y' if ignore else 'n'
 
-                # dcm2niix flag for ignoring derived (e.g, dwi FA, TRACEW, etc),
-                # localizer and 2D images
-                do_ignore = 'y' if ignore else 'n'
+    # Run dcm2niix conversions into working conversion directories
+    # Each conversion is an independent external process, so several can run at once
+    # Sessions are organized in order as soon as their own conversion completes,
+    # overlapping organization with the remaining conversions
+    # participants.tsv is kept open across sessions and only touched in the second pass
+    with conversion_pool(n_jobs) as executor, btr.ParticipantsWriter(dataset_dir) as participants:
 
-                # Compose command
-                cmd = ['dcm2niix',
-                       '-b', 'y',  # Create BIDS JSON sidecar
-                       '-ba', anon,
-                       '-i', do_ignore,
-                       '-z', gzip_type,
-                       '-w', '1',  # Overwrite existing files in work/
-                       '-f', '%n--%d--s%s--e%e',
-                       '-o', work_conv_dir,
-                       dcm_dir]
+        if conv_jobs:
+            print('')
+            print(f'Converting {len(conv_jobs)} DICOM folders with dcm2niix ({n_jobs} parallel jobs)')
+
+        conv_futures = {
+            work_conv_dir: executor.submit(
+                d2n.run_dcm2niix, dcm_dir, work_conv_dir, anon, do_ignore, gzip_type, ser_descs)
+            for dcm_dir, work_conv_dir, ser_descs in conv_jobs
+        }
+
+        # Organize dcm2niix output for each subject/session in turn
+        # Organization updates the shared translator so must run sequentially
+        for sid, sid_clean, ses_clean, dcm_dir, work_conv_dir, bids_ses_dir in session_list_all:
 
-                with open(os.devnull, 'w') as devnull:
-                    subprocess.run(cmd, stdout=devnull, stderr=devnull)
+            # Wait for this session's conversion to finish
+            if work_conv_dir in conv_futures:
+                conv_futures[work_conv_dir].result()
 
-            if not first_pass:
+            print('')
+            print('------------------------------------------------------------')
+            if ses_clean:
+                print(f'Processing subject {sid} session {ses_clean}')
+            else:
+                print(f'Processing subject {sid}')
+            print('------------------------------------------------------------')
+
+            if first_pass:
+
+                existing = None
+
+            else:
 
                 # Get subject age and sex from representative DICOM header
                 dcm_info = bio.dcm_info(dcm_dir)
 
                 # Add line to participants TSV file
-                btr.add_participant_record(dataset_dir, sid_clean, dcm_info['Age'], dcm_info['Sex'])
+                participants.add(sid_clean, dcm_info['Age'], dcm_info['Sex'])
+
+                # Snapshot existing BIDS output files once for this subject/session
+                existing = bio.list_existing_files(bids_ses_dir)
 
             # Organize dcm2niix output into BIDS subject/session directories
             d2n.organize_series(
@@ -364,9 +455,14 @@ def main():
                 nii_ext,
                 args.clean_conv_dir,
                 overwrite,
-                auto
+                auto,
+                existing,
+                btree.translator_sha1
             )
 
+    # Finish any background cleanup of conversion directories
+    d2n.wait_for_cleanup()
+
     if first_pass:
 
         # Write a template or auto built translator dictionary to code/Protocol_Translator.json
@@ -376,8 +472,10 @@ def main():
 
         print('Subject directories tagged for IntendedFor pruning:  ' + ', '.join(out_subj_dir_list))
 
-        for bids_subj_dir in out_subj_dir_list:
-            fmaps.prune_intendedfors(bids_subj_dir, True)
+        # Subject directories are pruned independently, so overlap their JSON reads and rewrites
+        with ThreadPoolExecutor(max_workers=max(1, min(bio.IO_THREADS, len(out_subj_dir_list)))) as executor:
+            list(executor.map(lambda bids_subj_dir: fmaps.prune_intendedfors(bids_subj_dir, True),
+                              out_subj_dir_list))
 
     if not first_pass:
 
@@ -396,6 +494,27 @@ def main():
     sys.exit(0)
 
 
+@contextmanager
+def conversion_pool(n_jobs):
+    """
+    Thread pool for dcm2niix conversions which drops queued jobs on early exit
+    (errors, sys.exit or Ctrl-C) rather than waiting for every one to run
+
+    :param n_jobs: int
+        Number of conversions to run at once
+    """
+
+    executor = ThreadPoolExecutor(max_workers=n_jobs)
+
+    try:
+        yield executor
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+
+    executor.shutdown(wait=True)
+
+
 # This is the standard boilerplate that calls the main() function.
 if __name__ == '__main__':
     main()
@@ -24,28 +24,152 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import numpy as np
-import datetime as dt
+import os
+import re
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 from . import io as bio
 
+# Pull the AcquisitionTime value directly from raw sidecar text
+ACQTIME_RE = re.compile(rb'"AcquisitionTime"\s*:\s*"([^"]+)"')
+
+
+def acqtime_to_mins(acq_time):
+    """
+    Convert a DICOM-style acquisition time string to minutes after midnight
+    :param acq_time: str, acquisition time 'HH:MM:SS[.ffffff]' (dcm2niix) or 'HHMMSS[.ffffff]' (DICOM TM)
+    :return: t_mins: float, minutes after midnight
+    :raises ValueError: unrecognized time format
+    """
+
+    hms, _, frac = acq_time.partition('.')
+    if ':' in hms:
+        hh, mm, ss = hms.split(':')
+    elif len(hms) == 6:
+        hh, mm, ss = hms[:2], hms[2:4], hms[4:]
+    else:
+        raise ValueError(f'unrecognized acquisition time {acq_time}')
+    t_secs = int(hh) * 3600 + int(mm) * 60 + int(ss)
+    if frac:
+        t_secs += int(frac) / 10 ** len(frac)
+
+    return t_secs / 60.0
+
 
 def acqtime_mins(json_file):
     """
     Extract acquisition time from JSON sidecar of Nifti file
+    Results are cached by filename, modification time and size
     :param json_file: str, JSON sidecar filename
-    :return: acq_time: int, integer datetime
+    :return: acq_time: float, minutes after midnight
+    """
+
+    try:
+        st = os.stat(json_file)
+        mtime_ns, size = st.st_mtime_ns, st.st_size
+    except OSError:
+        # Missing sidecar is reported by the uncached parse
+        mtime_ns, size = None, None
+
+    return _acqtime_mins_cached(json_file, mtime_ns, size)
+
+
+def acqtime_mins_batch(json_files, max_workers=None):
+    """
+    Extract acquisition times from a list of JSON sidecars
+    Sidecar reads are overlapped using a thread pool
+    :param json_files: list of str, JSON sidecar filenames
+    :param max_workers: int, maximum number of reader threads (default bidskit.io.IO_THREADS)
+    :return: t_mins: list of float, acquisition times in minutes (-1 if missing)
+    """
+
+    return _map_sidecars(acqtime_mins, json_files, max_workers)
+
+
+def read_json_acqtime(json_file):
+    """
+    Read a JSON sidecar and extract its acquisition time from the same parse
+    Use when the sidecar dictionary is needed afterwards (eg to rewrite IntendedFor)
+    :param json_file: str, JSON sidecar filename
+    :return: t_mins: float, minutes after midnight (-1 if missing)
+    :return: info: dict, sidecar contents
     """
 
     info = bio.read_json(json_file)
 
+    return info_acqtime_mins(info, json_file), info
+
+
+def read_json_acqtime_batch(json_files, max_workers=None):
+    """
+    Read a list of JSON sidecars with their acquisition times (see read_json_acqtime)
+    Sidecar reads are overlapped using a thread pool
+    :param json_files: list of str, JSON sidecar filenames
+    :param max_workers: int, maximum number of reader threads (default bidskit.io.IO_THREADS)
+    :return: list of (t_mins, info) tuples
+    """
+
+    return _map_sidecars(read_json_acqtime, json_files, max_workers)
+
+
+def _map_sidecars(func, json_files, max_workers=None):
+    """
+    Apply a sidecar reader to a list of JSON files, overlapping reads in a thread pool
+    """
+
+    if max_workers is None:
+        max_workers = bio.IO_THREADS
+
+    if len(json_files) < 2 or max_workers < 2:
+        results = [func(json_file) for json_file in json_files]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(json_files))) as executor:
+            results = list(executor.map(func, json_files))
+
+    return results
+
+
+@lru_cache(maxsize=4096)
+def _acqtime_mins_cached(json_file, mtime_ns, size):
+    """
+    Cached acquisition time extraction (see acqtime_mins)
+    Only the AcquisitionTime field is needed, so scan the raw sidecar for it
+    and fall back to a full JSON parse if the field isn't found
+    """
+
+    try:
+        with open(json_file, 'rb', buffering=0) as fd:
+            match = ACQTIME_RE.search(fd.read())
+    except IOError:
+        match = None
+
+    if match:
+        info = {'AcquisitionTime': match.group(1).decode('utf-8')}
+    else:
+        info = bio.read_json(json_file)
+
+    return info_acqtime_mins(info, json_file)
+
+
+def info_acqtime_mins(info, json_file):
+    """
+    Acquisition time from a sidecar dictionary, with warnings if missing or unrecognized
+    :param info: dict, sidecar contents
+    :param json_file: str, JSON sidecar filename (for warnings)
+    :return: t_mins: float, minutes after midnight (-1 if missing)
+    """
+
     if 'AcquisitionTime' in info:
-        t1 = dt.datetime.strptime(info['AcquisitionTime'], '%H:%M:%S.%f0')
-        t0 = dt.datetime(1900, 1, 1)
-        t_mins = float((t1 - t0).total_seconds() / 60.0)
+        try:
+            t_mins = acqtime_to_mins(info['AcquisitionTime'])
+        except ValueError:
+            print(f'* WARNING: Unrecognized AcquisitionTime {info["AcquisitionTime"]} in {json_file}')
+            print('* WARNING: Automatic fieldmap binding will not work correctly')
+            t_mins = -1
     else:
         print(f'* WARNING: AcquisitionTime not found in {json_file} (deidentified?)')
-        print(f'* WARNING: Automatic fieldmap binding will not work correctly')
+        print('* WARNING: Automatic fieldmap binding will not work correctly')
         t_mins = -1
 
-    return t_mins
\ No newline at end of file
+    return t_mins
@@ -26,10 +26,10 @@ SOFTWARE.
 
 import os
 import sys
-import json
 import subprocess
 import pkg_resources
 import shutil
+import hashlib
 
 from . import io as bio
 
@@ -58,6 +58,9 @@ class BIDSTree:
         # code/Protocol_Translator.json file path
         self.translator_file = os.path.join(self.code_dir, 'Protocol_Translator.json')
 
+        # SHA-1 of the translator file contents when last read (see read_translator)
+        self.translator_sha1 = None
+
         print('Creating file templates required for BIDS compliance')
 
         # Copy BIDS-compliant JSON templates to BIDS directory root
@@ -82,9 +85,8 @@ class BIDSTree:
 
         else:
 
-            json_fd = open(self.translator_file, 'w')
-            json.dump(translator, json_fd, indent=4, separators=(',', ':'))
-            json_fd.close()
+            with open(self.translator_file, 'wb') as json_fd:
+                json_fd.write(bio.json_dumps(translator))
 
             print('')
             print('---')
@@ -106,13 +108,17 @@ class BIDSTree:
         if os.path.isfile(self.translator_file):
 
             # Read JSON protocol translator
-            json_fd = open(self.translator_file, 'r')
-            translator = json.load(json_fd)
-            json_fd.close()
+            with open(self.translator_file, 'rb', buffering=0) as json_fd:
+                translator_bytes = json_fd.read()
+            translator = bio.json_loads(translator_bytes)
+
+            # Fingerprint the translator as edited on disk, before organization modifies it in memory
+            self.translator_sha1 = hashlib.sha1(translator_bytes).hexdigest()
 
         else:
 
             translator = dict()
+            self.translator_sha1 = None
 
         return translator
 
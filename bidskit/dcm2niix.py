@@ -25,30 +25,119 @@ import sys
 import re
 import subprocess
 import shutil
-import copy
-from glob import glob
+import threading
+import logging
+import numpy as np
 
 from . import io as bio
 from . import translate as tr
 from . import fmaps
-from .bidsjson import (acqtime_mins)
+from .bidsjson import (acqtime_mins_batch)
 
+logger = logging.getLogger(__name__)
 
-def ordered_file_list(conv_dir, nii_ext):
+# Background conversion directory cleanup threads and any directories they failed to remove
+# (see wait_for_cleanup)
+cleanup_threads = []
+cleanup_failures = set()
+
+# Hidden index of sidecar acquisition times kept in each conversion directory
+# Written during Pass 1 and reused by Pass 2 for unchanged sidecars
+CONV_INDEX_FNAME = '.bidskit_index.json'
+
+# Hidden manifest of the last Pass 2 organization of each conversion directory
+CONV_MANIFEST_FNAME = '.bidskit_manifest.json'
+
+# Maximum number of series CRCs accepted by a single dcm2niix call (dcm2niix -n)
+MAX_SERIES_CRCS = 16
+
+# dcm2niix version string in usage output (eg v1.0.20220720)
+DCM2NIIX_VERSION_RE = re.compile(rb'v\d+\.\d+\.\d+')
+
+
+def run_dcm2niix(dcm_dir, work_conv_dir, anon, do_ignore, gzip_type, ser_descs=None):
+    """
+    Run dcm2niix conversion of a DICOM folder into a working conversion directory
+
+    :param dcm_dir: str, DICOM session or subject folder
+    :param work_conv_dir: str, working conversion directory
+    :param anon: str, dcm2niix BIDS anonymization flag ('y' or 'n')
+    :param do_ignore: str, dcm2niix flag for ignoring derived, localizer and 2D images ('y' or 'n')
+    :param gzip_type: str, dcm2niix gzip compression flag
+    :param ser_descs: set of str, only convert series with these descriptions (None = all series)
+    :return:
+    """
+
+    # Restrict conversion to selected series using dcm2niix series CRCs
+    crc_args = []
+    if ser_descs:
+
+        crcs = bio.series_crcs(dcm_dir, ser_descs)
+
+        if not crcs:
+            logger.info('  No series matching %s in %s - skipping conversion', ', '.join(sorted(ser_descs)), dcm_dir)
+            return
+
+        if len(crcs) > MAX_SERIES_CRCS:
+            logger.warning('* WARNING: %d matching series in %s - converting all series', len(crcs), dcm_dir)
+        else:
+            logger.info('  Converting %d selected series in %s', len(crcs), dcm_dir)
+            for crc in crcs:
+                crc_args += ['-n', str(crc)]
+
+    if not crc_args:
+        logger.info('  Converting all DICOM images in %s', dcm_dir)
+
+    # Compose command
+    cmd = ['dcm2niix',
+           '-b', 'y',  # Create BIDS JSON sidecar
+           '-ba', anon,
+           '-i', do_ignore,
+           '-z', gzip_type,
+           '-w', '1',  # Overwrite existing files in work/
+           '-f', '%n--%d--s%s--e%e',
+           '-o', work_conv_dir] + crc_args + [dcm_dir]
+
+    # Discard progress output but keep error messages for reporting failed conversions
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    # Runs in a worker thread, so report through the logger as a single message to avoid
+    # interleaving with organization output from the main thread
+    if result.returncode != 0:
+        stderr_lines = result.stderr.decode('utf-8', errors='replace').splitlines()
+        logger.warning('\n'.join(['* WARNING: dcm2niix returned %d for %s' % (result.returncode, dcm_dir)] +
+                                  ['* dcm2niix: %s' % line for line in stderr_lines]))
+
+
+def ordered_file_list(conv_dir, nii_ext, conv_fnames=None):
     """
     Generated list of dcm2niix Nifti output files ordered by acquisition time
+    Images without a JSON sidecar are skipped with a warning
     :param conv_dir: str, working conversion directory
+    :param conv_fnames: set of str, optional precomputed listing of conv_dir filenames
     :return:
     """
 
-    # Get Nifti image list from conversion directory
-    nii_list = sorted(glob(os.path.join(conv_dir, '*.nii*')))
-
-    # Derive JSON sidecar list
-    json_list = [bio.nii_to_json(nii_file, nii_ext) for nii_file in nii_list]
+    # Snapshot conversion directory contents in a single pass
+    if conv_fnames is None:
+        with os.scandir(conv_dir) as it:
+            conv_fnames = {entry.name for entry in it if not entry.name.startswith('.')}
+
+    # Get Nifti image and JSON sidecar lists from conversion directory
+    # Sidecar existence is checked against the directory snapshot
+    nii_list, json_list = [], []
+    for nii_fname in sorted(conv_fnames):
+        if nii_fname.endswith(('.nii', '.nii.gz')):
+            json_fname = bio.nii_to_json(nii_fname, nii_ext)
+            if json_fname in conv_fnames:
+                nii_list.append(os.path.join(conv_dir, nii_fname))
+                json_list.append(os.path.join(conv_dir, json_fname))
+            else:
+                print('* WARNING: JSON sidecar %s not found' % os.path.join(conv_dir, json_fname))
 
     # Pull acquisition times for each Nifti image from JSON sidecar
-    acqtime_list = [acqtime_mins(json_file) for json_file in json_list]
+    # Sidecars unchanged since the last indexing of this directory are not re-read
+    acqtime_list = indexed_acqtimes(conv_dir, json_list)
 
     # Check for any negative acqtimes returned by acqtime_mins()
     if any(t < 0 for t in acqtime_list):
@@ -64,14 +153,60 @@ def ordered_file_list(conv_dir, nii_ext):
 
         print('  Sorting series by acquisition time')
 
-        # Sort Nifti and JSON file lists by acquisition time
-        nii_sorted = [file for _, file in sorted(zip(acqtime_list, nii_list))]
-        json_sorted = [file for _, file in sorted(zip(acqtime_list, json_list))]
-        acq_sorted = sorted(acqtime_list)
+        # Sort Nifti and JSON file lists by acquisition time in a single pass
+        # Lists are already in filename order, so a stable sort breaks ties by Nifti filename
+        order = np.argsort(acqtime_list, kind='stable')
+        nii_sorted = [nii_list[i] for i in order]
+        json_sorted = [json_list[i] for i in order]
+        acq_sorted = [acqtime_list[i] for i in order]
 
     return nii_sorted, json_sorted, acq_sorted
 
 
+def indexed_acqtimes(conv_dir, json_list):
+    """
+    Acquisition times for a list of JSON sidecars using the conversion directory index
+    Sidecars missing from the index or modified since indexing are re-read and the index updated
+    :param conv_dir: str, working conversion directory
+    :param json_list: list of str, JSON sidecar filenames in conv_dir
+    :return: acqtime_list: list of float, acquisition times in minutes (-1 if missing)
+    """
+
+    index_fname = os.path.join(conv_dir, CONV_INDEX_FNAME)
+
+    try:
+        with open(index_fname, 'rb') as fd:
+            index = bio.json_loads(fd.read())
+    except (IOError, ValueError):
+        index = {}
+
+    # Current modification time and size of each sidecar
+    json_keys = []
+    for json_fname in json_list:
+        st = os.stat(json_fname)
+        json_keys.append([st.st_mtime_ns, st.st_size])
+
+    # Indices of sidecars needing a fresh read
+    stale = [jc for jc, json_fname in enumerate(json_list)
+             if index.get(os.path.basename(json_fname), [None, None])[:2] != json_keys[jc]]
+
+    if stale or len(index) != len(json_list):
+
+        for jc, t_mins in zip(stale, acqtime_mins_batch([json_list[jc] for jc in stale])):
+            index[os.path.basename(json_list[jc])] = json_keys[jc] + [t_mins]
+
+        # Drop entries for sidecars no longer present
+        index = {os.path.basename(json_fname): index[os.path.basename(json_fname)] for json_fname in json_list}
+
+        try:
+            with open(index_fname, 'wb') as fd:
+                fd.write(bio.json_dumps(index))
+        except IOError:
+            print('* WARNING: could not write conversion index %s' % index_fname)
+
+    return [index[os.path.basename(json_fname)][2] for json_fname in json_list]
+
+
 def organize_series(
         conv_dir,
         first_pass,
@@ -83,7 +218,9 @@ def organize_series(
         nii_ext,
         do_cleanup=False,
         overwrite=False,
-        auto=False):
+        auto=False,
+        existing=None,
+        translator_sha1=None):
     """
     Organize dcm2niix output in the work/ folder into BIDS
 
@@ -109,14 +246,36 @@ def organize_series(
         Nifti compression method for dcm2niix ('n' = no compression)
     :param auto: bool
         auto build translator dictionary from dcm2niix output in work/
+    :param existing: set of str
+        snapshot of existing files in src_dir (see bidskit.io.list_existing_files)
+    :param translator_sha1: str
+        SHA-1 of the translator file as read from disk (see BIDSTree.read_translator)
+        Unchanged Pass 2 organizations are only skipped if provided
     :return:
     """
 
     # Proceed if conversion directory exists
     if os.path.isdir(conv_dir):
 
+        # Skip Pass 2 organization if neither the conversion output nor the translator has changed
+        # since this directory was last organized and all the BIDS output from that run still exists
+        if not first_pass:
+
+            manifest = conversion_manifest(conv_dir, translator_sha1, nii_ext, key_flags)
+            manifest_fname = os.path.join(conv_dir, CONV_MANIFEST_FNAME)
+
+            if not overwrite and translator_sha1 and manifest_unchanged(manifest_fname, manifest, existing):
+                print('  Conversion and translator unchanged since last run - skipping organization')
+                cleanup_conv_dir(conv_dir, do_cleanup)
+                return
+
         # Get Nifti file list ordered by acquisition time
-        nii_list, json_list, acq_times = ordered_file_list(conv_dir, nii_ext)
+        # Pass 2 reuses the directory listing from the manifest
+        if first_pass:
+            nii_list, json_list, acq_times = ordered_file_list(conv_dir, nii_ext)
+        else:
+            conv_fnames = {conv_file[0] for conv_file in manifest['Files']}
+            nii_list, json_list, acq_times = ordered_file_list(conv_dir, nii_ext, conv_fnames)
 
         # Infer run numbers accounting for duplicates.
         # Only used if run-* not present in translator BIDS filename stub
@@ -125,6 +284,12 @@ def organize_series(
         else:
             run_no = tr.auto_run_no(nii_list, translator)
 
+        # BIDS filename prefix for this subject and session
+        if ses:
+            bids_prefix = f'sub-{sid}_ses-{ses}_'
+        else:
+            bids_prefix = f'sub-{sid}_'
+
         # Loop over all Nifti files (*.nii, *.nii.gz) for this subject
         for fc, src_nii_fname in enumerate(nii_list):
 
@@ -141,7 +306,7 @@ def organize_series(
             # Check if we're creating a new protocol dictionary
             if first_pass:
 
-                print(f"\n  Adding protocol {ser_desc} to dictionary")
+                logger.info('\n  Adding protocol %s to dictionary', ser_desc)
 
                 # Add current protocol to protocol dictionary
                 if auto:
@@ -151,25 +316,25 @@ def organize_series(
 
             else:
 
-                # Warn if not found and continue
-                if not os.path.isfile(src_json_fname):
-                    print('* WARNING: JSON sidecar %s not found' % src_json_fname)
-                    continue
+                prot_entry = translator.get(ser_desc)
 
-                if ser_desc in translator.keys():
+                if prot_entry is not None:
 
-                    if translator[ser_desc][0].startswith('EXCLUDE'):
+                    if prot_entry[0].startswith('EXCLUDE'):
 
                         # Skip excluded protocols
-                        print(f'* Excluding protocol {ser_desc}')
+                        logger.info('* Excluding protocol %s', ser_desc)
 
                     else:
 
-                        print(f'  Organizing {ser_desc}')
+                        logger.info('  Organizing %s', ser_desc)
 
                         # Use protocol dictionary to determine purpose folder, BIDS filename suffix and fmap linking
-                        # Note use of deepcopy to prevent corruption of translator (see Issue #36 solution by @bogpetre)
-                        bids_purpose, bids_stub, bids_intendedfor = copy.deepcopy(translator[ser_desc])
+                        # IntendedFor lists are modified below, so copy them to prevent corruption of translator
+                        # (see Issue #36 solution by @bogpetre). Strings are immutable and need no copy
+                        bids_purpose, bids_stub, bids_intendedfor = prot_entry
+                        if not isinstance(bids_intendedfor, str):
+                            bids_intendedfor = list(bids_intendedfor)
 
                         # Safely add run-* key to BIDS suffix
                         bids_stub = tr.add_run_number(bids_stub, run_no[fc])
@@ -181,16 +346,10 @@ def organize_series(
                         bids_purpose_dir = os.path.join(src_dir, bids_purpose)
                         bio.safe_mkdir(bids_purpose_dir)
 
-                        # Complete BIDS filenames for image and sidecar
-                        if ses:
-                            bids_prefix = f'sub-{sid}_ses-{ses}_'
-                        else:
-                            bids_prefix = f'sub-{sid}_'
-
                         # Construct BIDS Nifti and JSON filenames
                         # Issue 105: remember to account for --compress n flag with .nii extension
                         bids_nii_fname = os.path.join(bids_purpose_dir, bids_prefix + bids_stub + nii_ext)
-                        bids_json_fname = bids_nii_fname.replace(nii_ext, '.json')
+                        bids_json_fname = bids_nii_fname[:-len(nii_ext)] + '.json'
 
                         # Add prefix and suffix to IntendedFor values
                         if 'UNASSIGNED' not in bids_intendedfor:
@@ -215,7 +374,8 @@ def organize_series(
                                             bids_json_fname,
                                             key_flags,
                                             overwrite,
-                                            nii_ext)
+                                            nii_ext,
+                                            existing)
                 else:
 
                     # Skip protocols not in the dictionary
@@ -223,15 +383,146 @@ def organize_series(
 
         if not first_pass:
 
-            # Optional working directory cleanup after Pass 2
-            if do_cleanup:
-                print('  Cleaning up temporary files')
-                shutil.rmtree(conv_dir)
-            else:
-                print('  Preserving conversion directory')
+            # Finish background image copies before listing outputs or cleaning up the conversion directory
+            bio.wait_for_copies()
+
+            # Record this organization so that an unchanged rerun can be skipped
+            # Conversion files are listed again after organization, which rewrites some work sidecars in place
+            # (see fmaps.handle_fmap_case)
+            if not do_cleanup and translator_sha1:
+                manifest['Files'] = conversion_files(conv_dir)
+                manifest['Outputs'] = sorted(bio.list_existing_files(src_dir))
+                try:
+                    with open(manifest_fname, 'wb') as fd:
+                        fd.write(bio.json_dumps(manifest))
+                except IOError:
+                    print('* WARNING: could not write conversion manifest %s' % manifest_fname)
+
+            cleanup_conv_dir(conv_dir, do_cleanup)
+
+
+def conversion_manifest(conv_dir, translator_sha1, nii_ext, key_flags):
+    """
+    Summarize the inputs to Pass 2 organization of a conversion directory
+
+    :param conv_dir: str, working conversion directory
+    :param translator_sha1: str, SHA-1 of the translator file as read from disk
+    :param nii_ext: str, Nifti extension
+    :param key_flags: dict, filename key flags
+    :return: manifest: dict
+    """
+
+    manifest = {
+        'Files': conversion_files(conv_dir),
+        'Translator': translator_sha1,
+        'Extension': nii_ext,
+        'KeyFlags': key_flags
+    }
+
+    return manifest
 
 
-def handle_multiecho(work_json_fname, bids_json_fname, echo_flag, nii_ext):
+def conversion_files(conv_dir):
+    """
+    Name, modification time and size of each dcm2niix output file in a conversion directory
+
+    :param conv_dir: str, working conversion directory
+    :return: list of [name, mtime_ns, size], sorted by name
+    """
+
+    with os.scandir(conv_dir) as it:
+        conv_files = sorted([entry.name, entry.stat().st_mtime_ns, entry.stat().st_size]
+                            for entry in it if not entry.name.startswith('.'))
+
+    return conv_files
+
+
+def manifest_unchanged(manifest_fname, manifest, existing=None):
+    """
+    Check a current conversion manifest against the one saved by the last Pass 2 run
+
+    :param manifest_fname: str, saved manifest filename
+    :param manifest: dict, current manifest (see conversion_manifest)
+    :param existing: set of str, snapshot of existing BIDS output files
+    :return: bool, True if inputs are unchanged and all previous outputs still exist
+    """
+
+    try:
+        with open(manifest_fname, 'rb') as fd:
+            saved = bio.json_loads(fd.read())
+    except (IOError, ValueError):
+        return False
+
+    outputs = saved.pop('Outputs', [])
+
+    return saved == manifest and all(bio.file_exists(fname, existing) for fname in outputs)
+
+
+def cleanup_conv_dir(conv_dir, do_cleanup):
+    """
+    Optional working conversion directory cleanup after Pass 2
+    Deletion runs in the background so the next session can start immediately
+
+    :param conv_dir: str, working conversion directory
+    :param do_cleanup: bool, delete conversion directory
+    :return:
+    """
+
+    if do_cleanup:
+        print('  Cleaning up temporary files')
+        cleanup_thread = threading.Thread(target=remove_conv_dir, args=(conv_dir,), daemon=True)
+        cleanup_thread.start()
+        cleanup_threads.append(cleanup_thread)
+    else:
+        print('  Preserving conversion directory')
+
+
+def remove_conv_dir(conv_dir):
+    """
+    Delete a working conversion directory, logging anything that can't be removed
+    rather than stopping at the first failure
+
+    :param conv_dir: str, working conversion directory
+    :return:
+    """
+
+    def log_failure(func, path, exc):
+        # onerror passes an exc_info tuple, onexc the exception itself
+        if isinstance(exc, tuple):
+            exc = exc[1]
+        logger.warning('* WARNING: could not remove %s (%s)', path, exc)
+        cleanup_failures.add(conv_dir)
+
+    if sys.version_info >= (3, 12):
+        shutil.rmtree(conv_dir, onexc=log_failure)
+    else:
+        shutil.rmtree(conv_dir, onerror=log_failure)
+
+
+def wait_for_cleanup():
+    """
+    Wait for any background conversion directory cleanup to finish
+    and report any directories that could not be fully removed
+
+    :return: list of str
+        Conversion directories left behind
+    """
+
+    while cleanup_threads:
+        cleanup_threads.pop().join()
+
+    failures = sorted(cleanup_failures)
+    cleanup_failures.clear()
+
+    if failures:
+        logger.warning('* WARNING: %d conversion directories could not be fully removed:', len(failures))
+        for conv_dir in failures:
+            logger.warning('*   %s', conv_dir)
+
+    return failures
+
+
+def handle_multiecho(work_json_fname, bids_json_fname, echo_flag, nii_ext, json_data=None):
     """
     Handle multiecho recons converted using dcm2niix
     As of dcm2niix v1.0.20211220 multiple echo recons have suffices:
@@ -244,21 +535,23 @@ def handle_multiecho(work_json_fname, bids_json_fname, echo_flag, nii_ext):
         path to JSON sidecar in output BIDS tree
     :param echo_flag: bool
         flag to add echo- key to filename (if necessary)
+    :param json_data: dict
+        work JSON sidecar metadata if already loaded
     """
 
-    # Load BIDS sidecar metadata
-    bids_info = bio.read_json(work_json_fname)
+    # Load BIDS sidecar metadata unless already loaded by the caller
+    bids_info = bio.read_json(work_json_fname) if json_data is None else json_data
 
     # Init Nifti image fname
-    bids_nii_fname = bids_json_fname.replace('.json', '.nii.gz')
+    bids_nii_fname = bids_json_fname[:-len('.json')] + nii_ext
 
     # DICOM EchoNumber tag only present for multiecho sequences
     if 'EchoNumber' in bids_info.keys():
 
         echo_num = bids_info['EchoNumber']
 
-        print(f'    Multiple echoes detected')
-        print(f'    Echo number {echo_num:d}')
+        logger.info('    Multiple echoes detected')
+        logger.info('    Echo number %d', echo_num)
 
         # Add an "echo-{echo_num}" key to the BIDS Nifti and JSON filenames
         if echo_flag:
@@ -293,22 +586,22 @@ def handle_complex(work_json_fname, bids_json_fname, part_flag, nii_ext):
 
         # Check for phase image first
         if suffix.endswith('ph'):
-            print('    Phase image detected')
+            logger.info('    Phase image detected')
             bids_keys['part'] = 'phase'
         else:
-            print('    Magnitude image detected')
+            logger.info('    Magnitude image detected')
             bids_keys['part'] = 'mag'
 
     # Modify JSON filename with complex part key
     bids_json_fname = tr.bids_keys_to_filename(bids_keys, bids_dname)
 
     # Construct associated BIDS Nifti filename
-    bids_nii_fname = bids_json_fname.replace('.json', nii_ext)
+    bids_nii_fname = bids_json_fname[:-len('.json')] + nii_ext
 
     return bids_nii_fname, bids_json_fname
 
 
-def handle_bias_recon(work_json_fname, bids_json_fname, recon_flag, nii_ext):
+def handle_bias_recon(work_json_fname, bids_json_fname, recon_flag, nii_ext, json_data=None):
     """
     Handle bias correction (Siemens NORM flag)
 
@@ -318,10 +611,12 @@ def handle_bias_recon(work_json_fname, bids_json_fname, recon_flag, nii_ext):
         path to JSON sidecar in output BIDS tree
     :param recon_flag: bool
         flag to add rec- key to filename (if necessary)
+    :param json_data: dict
+        work JSON sidecar metadata if already loaded
     """
 
-    # Load recon type from work JSON sidecar
-    work_json = bio.read_json(work_json_fname)
+    # Load recon type from work JSON sidecar unless already loaded by the caller
+    work_json = bio.read_json(work_json_fname) if json_data is None else json_data
     image_type = work_json['ImageType']
     recon_value = 'norm' if 'NORM' in image_type else 'bias'
 
@@ -329,7 +624,7 @@ def handle_bias_recon(work_json_fname, bids_json_fname, recon_flag, nii_ext):
     if recon_flag:
         bids_nii_fname, bids_json_fname = tr.add_bids_key(bids_json_fname, 'rec', recon_value, nii_ext)
     else:
-        bids_nii_fname = bids_json_fname.replace('.json', nii_ext)
+        bids_nii_fname = bids_json_fname[:-len('.json')] + nii_ext
 
     return bids_nii_fname, bids_json_fname
 
@@ -348,32 +643,43 @@ def dcm2niix_json_fname(d2n_meta, ser_no, echo_no, suffix):
     """
 
     # Construct dcm2niix mag1 filename
-    fname = '{}--{}--s{}--e{}{}.json'.format(
-        d2n_meta['SubjName'],
-        d2n_meta['SerDesc'],
-        ser_no,
-        echo_no,
-        suffix
-    )
+    fname = f"{d2n_meta['SubjName']}--{d2n_meta['SerDesc']}--s{ser_no}--e{echo_no}{suffix}.json"
 
     fname_full = os.path.join(d2n_meta['DirName'], fname)
 
     return fname_full
 
 
+def version_tuple(version):
+    """
+    Convert a dcm2niix version string to a tuple of ints for comparison
+    :param version: str, version string (eg 'v1.0.20220720')
+    :return: tuple of int
+    """
+
+    return tuple(int(x) for x in version.lstrip('v').split('.'))
+
+
 def check_dcm2niix_version(min_version='v1.0.20220720'):
 
     print(f'\nCheck dcm2nixx version')
-    output = subprocess.check_output('dcm2niix')
+
+    # dcm2niix without arguments prints its version in the first line of the usage text
+    # Some builds exit with a non-zero status here, so don't treat that as a failure
+    try:
+        output = subprocess.run(['dcm2niix'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        output = b''
 
     # Search for version in output
-    match = re.findall(b"v\d.\d.\d+", output)
+    match = DCM2NIIX_VERSION_RE.search(output)
 
     if match:
 
-        version = match[0].decode('utf-8')
+        version = match.group(0).decode('utf-8')
 
-        if version < min_version:
+        # Compare numerically (eg v1.0.20181125 is later than v1.0.9)
+        if version_tuple(version) < version_tuple(min_version):
             print(f'dcm2niix {version} detected - please update to {min_version} or later\n')
             sys.exit(1)
         else:
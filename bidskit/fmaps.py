@@ -21,15 +21,20 @@ SOFTWARE.
 """
 
 import os
-import json
+import logging
 import bids
 import numpy as np
-from glob import glob
 
 from . import io as bio
 from . import dcm2niix as d2n
 from . import translate as tr
-from .bidsjson import (acqtime_mins)
+from .bidsjson import (acqtime_mins_batch, read_json_acqtime_batch)
+
+# Per-series progress messages are logged at INFO level (see --quiet)
+logger = logging.getLogger(__name__)
+
+# Fieldmap count at which nearest_fmaps switches from plain Python to numpy broadcasting
+NEAREST_FMAP_MIN_VECTOR = 16
 
 
 def bind_fmaps(bids_subj_dir, no_sessions, nii_ext):
@@ -51,7 +56,8 @@ def bind_fmaps(bids_subj_dir, no_sessions, nii_ext):
     if no_sessions:
         subjsess_dirs = [bids_subj_dir]
     else:
-        subjsess_dirs = sorted(glob(os.path.join(bids_subj_dir, 'ses-*')))
+        subjsess_dirs = [os.path.join(bids_subj_dir, name)
+                         for name in list_dir(bids_subj_dir, dirs_only=True) if name.startswith('ses-')]
 
     # Subject/session loop
     for subjsess_dir in subjsess_dirs:
@@ -59,18 +65,23 @@ def bind_fmaps(bids_subj_dir, no_sessions, nii_ext):
         print('    Subject/Session {}'.format(os.path.basename(subjsess_dir)))
 
         # Get list of BOLD fMRI JSON sidecars and acquisition times
-        bold_jsons = sorted(glob(os.path.join(subjsess_dir, 'func', '*task-*_bold.json')))
-        t_bold = np.array([acqtime_mins(fname) for fname in bold_jsons])
+        # No lexical sort needed - BOLD series are matched to fieldmaps by acquisition time
+        func_dir = os.path.join(subjsess_dir, 'func')
+        bold_jsons = [os.path.join(func_dir, name) for name in list_dir(func_dir)
+                      if 'task-' in name and name.endswith('_bold.json')]
+        t_bold = np.array(acqtime_mins_batch(bold_jsons))
 
-        # Find all SE-EPI fieldmap JSONs in session fmap/ folder
+        # List session fmap/ folder once
         fmap_dir = os.path.join(subjsess_dir, 'fmap')
-        epi_fmap_jsons = sorted(glob(os.path.join(fmap_dir, '*_dir-*_epi.json')))
+        fmap_names = list_dir(fmap_dir)
+
+        # Find all SE-EPI fieldmap JSONs in session fmap/ folder
+        epi_fmap_jsons = [os.path.join(fmap_dir, name) for name in fmap_names
+                          if '_dir-' in name and name.endswith('_epi.json')]
 
         # Find all GRE fieldmap JSONs in session fmap/ folder
-        gre_fmap_jsons = sorted(
-            glob(os.path.join(fmap_dir, '*_phase*.json')) +
-            glob(os.path.join(fmap_dir, '*_magnitude*.json'))
-        )
+        gre_fmap_jsons = [os.path.join(fmap_dir, name) for name in fmap_names
+                          if name.endswith('.json') and ('_phase' in name or '_magnitude' in name)]
 
         if epi_fmap_jsons:
             bind_epi_fmaps(epi_fmap_jsons, bold_jsons, t_bold, no_sessions, nii_ext)
@@ -80,6 +91,25 @@ def bind_fmaps(bids_subj_dir, no_sessions, nii_ext):
             print(f"    * No fieldmaps detected in {fmap_dir} - skipping")
 
 
+def list_dir(dname, dirs_only=False):
+    """
+    Sorted names in a directory from a single scandir pass, skipping hidden entries (as glob does)
+
+    :param dname: str, directory path
+    :param dirs_only: bool, only list subdirectories
+    :return: list of str, entry names (empty if the directory is missing)
+    """
+
+    try:
+        with os.scandir(dname) as it:
+            names = [entry.name for entry in it
+                     if not entry.name.startswith('.') and (not dirs_only or entry.is_dir())]
+    except OSError:
+        names = []
+
+    return sorted(names)
+
+
 def bind_epi_fmaps(epi_fmap_jsons, bold_jsons, t_bold, no_sessions, nii_ext):
     """
     SE-EPI fieldmap binding
@@ -100,6 +130,9 @@ def bind_epi_fmaps(epi_fmap_jsons, bold_jsons, t_bold, no_sessions, nii_ext):
             dirs.append(ents['direction'])
     pedirs = np.unique(dirs)
 
+    # IntendedFor names for each BOLD series are the same for all PE directions
+    bold_intended = [bids_intended_name(bold_json, no_sessions, nii_ext) for bold_json in bold_jsons]
+
     # Loop over phase encoding directions
     for pedir in pedirs:
 
@@ -111,26 +144,44 @@ def bind_epi_fmaps(epi_fmap_jsons, bold_jsons, t_bold, no_sessions, nii_ext):
         # Create list for storing IntendedFor lists
         intended_for = [[] for ic in range(len(pedir_jsons))]
 
-        # Get SE-EPI fmap acquisition times
-        t_epi_fmap = np.array([acqtime_mins(fname) for fname in pedir_jsons])
-
-        # Find the closest fieldmap in time to each BOLD series
-        for ic, bold_json in enumerate(bold_jsons):
+        # Get SE-EPI fmap acquisition times and sidecars from a single read
+        fmap_meta = read_json_acqtime_batch(pedir_jsons)
+        t_epi_fmap = [t for t, _ in fmap_meta]
 
-            # Time difference between all fieldmaps in this direction and current BOLD series
-            dt = np.abs(t_bold[ic] - t_epi_fmap)
+        # Index of the closest fieldmap in time to each BOLD series
+        nearest = nearest_fmaps(t_bold, t_epi_fmap)
 
-            # Index of closest fieldmap to this BOLD series
-            idx = np.argmin(dt)
-
-            # Add this BOLD series image name to list for this fmap
-            intended_for[idx].append(bids_intended_name(bold_json, no_sessions, nii_ext))
+        # Add each BOLD series image name to list for its closest fmap
+        for ic, idx in enumerate(nearest):
+            intended_for[idx].append(bold_intended[ic])
 
         # Replace IntendedFor field in fmap JSON file
         for fc, json_fname in enumerate(pedir_jsons):
-            info = bio.read_json(json_fname)
-            info['IntendedFor'] = intended_for[fc]
-            bio.write_json(json_fname, info, overwrite=True)
+            update_intendedfor(json_fname, intended_for[fc], fmap_meta[fc][1])
+
+
+def nearest_fmaps(t_bold, t_fmap):
+    """
+    Index of the fieldmap closest in time to each BOLD series
+
+    :param t_bold: array of float, BOLD acquisition times (mins)
+    :param t_fmap: list of float, fieldmap acquisition times (mins)
+    :return: list of int, closest fieldmap index for each BOLD series
+    """
+
+    if len(t_fmap) < NEAREST_FMAP_MIN_VECTOR:
+
+        # Typical sessions have only a few fieldmaps per direction - plain Python avoids the numpy setup cost
+        fmap_inds = range(len(t_fmap))
+        nearest = [min(fmap_inds, key=lambda j: abs(tb - t_fmap[j])) for tb in np.asarray(t_bold).tolist()]
+
+    else:
+
+        # Time differences between all BOLD series (rows) and fieldmaps (columns)
+        t_fmap = np.asarray(t_fmap)
+        nearest = np.argmin(np.abs(np.asarray(t_bold)[:, None] - t_fmap[None, :]), axis=1).tolist()
+
+    return nearest
 
 
 def bind_gre_fmaps(gre_fmap_jsons, bold_jsons, t_bold, no_sessions, nii_ext):
@@ -148,30 +199,44 @@ def bind_gre_fmaps(gre_fmap_jsons, bold_jsons, t_bold, no_sessions, nii_ext):
     # Create list for storing IntendedFor lists
     intended_for = [[] for ic in range(len(gre_fmap_jsons))]
 
-    # Get SE-EPI fmap acquisition times
-    t_epi_fmap = np.array([acqtime_mins(fname) for fname in gre_fmap_jsons])
+    # Get GRE fmap acquisition times and sidecars from a single read
+    fmap_meta = read_json_acqtime_batch(gre_fmap_jsons)
+    t_epi_fmap = np.array([t for t, _ in fmap_meta])
 
-    # Find the closest fieldmap files in time to each BOLD series
+    # Time differences between all BOLD series (rows) and fieldmaps (columns)
+    dt = np.abs(t_bold[:, None] - t_epi_fmap[None, :])
+
+    # Flag the closest fieldmap to each BOLD series and any other images acquired within a short time (1 s)
+    # of the minimum dt. These should be the associated mag and phase echo recons
+    is_closest = np.abs(dt - dt.min(axis=1, keepdims=True)) < 1.0
+
+    # Add each BOLD series to the IntendedFor list for each of its closest fmap JSONs
     for ic, bold_json in enumerate(bold_jsons):
+        bold_intended = bids_intended_name(bold_json, no_sessions, nii_ext)
+        for ind in np.flatnonzero(is_closest[ic]):
+            intended_for[ind].append(bold_intended)
 
-        # Time differences between all fieldmaps and current BOLD series
-        dt = np.abs(t_bold[ic] - t_epi_fmap)
+    # Replace IntendedFor field in fmap JSON file
+    for fc, json_fname in enumerate(gre_fmap_jsons):
+        update_intendedfor(json_fname, intended_for[fc], fmap_meta[fc][1])
 
-        # Timestamp of closest fieldmap to this BOLD series
-        dt_min = np.min(dt)
 
-        # Find the indices of any other images acquired within a short time (1 s) of the minimum dt
-        # These should be the associated mag and phase echo recons
-        inds = np.where(np.abs(dt - dt_min) < 1.0)[0]
+def update_intendedfor(json_fname, intended_for, info=None):
+    """
+    Replace the IntendedFor field in a fieldmap JSON sidecar
+    The sidecar is only rewritten if the field changes
 
-        # Add the current BOLD series to the IntendedFor list for each of the closest fmap JSONs
-        for ind in inds:
-            intended_for[ind].append(bids_intended_name(bold_json, no_sessions, nii_ext))
+    :param json_fname: str, fieldmap JSON sidecar filename
+    :param intended_for: list of str, new IntendedFor entries
+    :param info: dict, sidecar contents if already read (eg by read_json_acqtime_batch)
+    :return:
+    """
 
-    # Replace IntendedFor field in fmap JSON file
-    for fc, json_fname in enumerate(gre_fmap_jsons):
+    if info is None:
         info = bio.read_json(json_fname)
-        info['IntendedFor'] = intended_for[fc]
+
+    if info.get('IntendedFor') != intended_for:
+        info['IntendedFor'] = intended_for
         bio.write_json(json_fname, info, overwrite=True)
 
 
@@ -214,36 +279,56 @@ def prune_intendedfors(bids_subj_dir, fmap_only):
         Only looks at json files in an fmap directory
     """
 
-    # Traverse through all directories in bids_subj_dir
-    for root, dirs, files in os.walk(bids_subj_dir):
-        for name in files:
+    bids_subj_dir = os.path.normpath(bids_subj_dir)
+    subj_prefix = bids_subj_dir + os.sep
 
-            # Only examine json files, ignore dataset_description, and only work in fmap directories if so specified
-            if (os.path.splitext(name)[1] == ".json" and
-                    not name == "dataset_description.json" and
-                    (not fmap_only or os.path.basename(root) == "fmap")):
+    # Snapshot all files in the subject directory tree in a single scandir pass
+    subj_files = set(bio.iter_files(bids_subj_dir))
 
-                with open(os.path.join(root, name), 'r+') as f:
+    for json_fname in subj_files:
 
-                    # Read json file
-                    data = json.load(f)
+        name = os.path.basename(json_fname)
 
-                    if 'IntendedFor' in data:
+        # Only examine json files, ignore dataset_description, and only work in fmap directories if so specified
+        if (name.endswith('.json') and
+                not name == "dataset_description.json" and
+                (not fmap_only or os.path.basename(os.path.dirname(json_fname)) == "fmap")):
 
-                        # Prune list of files that do not exist
-                        bids_intendedfor = []
-                        for i in data['IntendedFor']:
-                            i_fullpath = os.path.join(bids_subj_dir, i)
-                            if os.path.isfile(i_fullpath):
+            with open(json_fname, 'r+b') as f:
+
+                # Read json file
+                data = bio.json_loads(f.read())
+
+                if 'IntendedFor' in data:
+
+                    # A single linked image may be stored as a string
+                    orig_intendedfor = data['IntendedFor']
+                    if isinstance(orig_intendedfor, str):
+                        orig_intendedfor = [orig_intendedfor]
+
+                    # Prune list of files that do not exist
+                    # Targets within the subject directory are checked against the snapshot
+                    bids_intendedfor = []
+                    for i in orig_intendedfor:
+                        i_fullpath = os.path.normpath(os.path.join(bids_subj_dir, i))
+                        if i_fullpath.startswith(subj_prefix):
+                            if i_fullpath in subj_files:
                                 bids_intendedfor.append(i)
+                        elif os.path.isfile(i_fullpath):
+                            bids_intendedfor.append(i)
+
+                    # Leave the sidecar untouched if nothing was pruned
+                    if bids_intendedfor == orig_intendedfor:
+                        continue
 
-                        # Modify IntendedFor with pruned list
-                        data['IntendedFor'] = bids_intendedfor
+                    # Modify IntendedFor with pruned list
+                    data['IntendedFor'] = bids_intendedfor
 
-                        # Update json file
-                        f.seek(0)
-                        json.dump(data, f, indent=4)
-                        f.truncate()
+                    # Update json file
+                    f.seek(0)
+                    f.write(bio.json_dumps(data))
+                    f.truncate()
+                    bio.invalidate_json(json_fname)
 
 
 def handle_fmap_case(work_json_fname, bids_nii_fname, bids_json_fname):
@@ -300,10 +385,10 @@ def handle_fmap_case(work_json_fname, bids_nii_fname, bids_json_fname):
     fmap_case = None
     if os.path.isfile(e2p_fname):
         if os.path.isfile(e1p_fname):
-            print('    Detected GRE Fieldmap Case 2')
+            logger.info('    Detected GRE Fieldmap Case 2')
             fmap_case = 2
         else:
-            print('    Detected GRE Fieldmap Case 1')
+            logger.info('    Detected GRE Fieldmap Case 1')
             fmap_case = 1
     else:
         print('* GRE Fieldmap Echo 2 image missing - skipping')
@@ -331,15 +416,15 @@ def handle_fmap_case(work_json_fname, bids_nii_fname, bids_json_fname):
             te1 = e1m_info['EchoTime']
             te2 = e2p_info['EchoTime']
 
-            print(f'      GRE TE1 : {te1:0.5f} ms')
-            print(f'      GRE TE2 : {te2:0.5f} ms')
-            print(f'      GRE dTE : {(te2-te1):0.5f} ms')
+            logger.info('      GRE TE1 : %0.5f ms', te1)
+            logger.info('      GRE TE2 : %0.5f ms', te2)
+            logger.info('      GRE dTE : %0.5f ms', te2 - te1)
 
             e2p_info['EchoTime1'] = te1
             e2p_info['EchoTime2'] = te2
 
             # Re-write echo 2 phase JSON sidecar
-            print('    Updating Echo 2 Phase JSON sidecar')
+            logger.info('    Updating Echo 2 Phase JSON sidecar')
             bio.write_json(e2p_fname, e2p_info, overwrite=True)
 
     if fmap_case == 2:
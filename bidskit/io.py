@@ -27,9 +27,92 @@ SOFTWARE.
 import os
 import sys
 import shutil
+import logging
+import re
 import json
+import copy
+import zlib
 import pydicom
-import numpy as np
+from pydicom.tag import Tag
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-file progress messages are logged at DEBUG level (see --verbose)
+logger = logging.getLogger(__name__)
+
+# Optional fast JSON encoder/decoder
+try:
+    import orjson
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
+# Directories already created or confirmed by safe_mkdir in this process
+created_dirs = set()
+
+# Number of times each JSON file has been rewritten in this process (see invalidate_json)
+json_versions = dict()
+
+# Maximum number of threads for overlapped sidecar reads, rewrites and image copies
+# Override with the BIDSKIT_IO_THREADS environment variable (eg lower for NFS, higher for local SSD)
+try:
+    IO_THREADS = max(1, int(os.environ.get('BIDSKIT_IO_THREADS', 8)))
+except ValueError:
+    IO_THREADS = 8
+
+# Thread pool and pending futures (keyed by destination) for background image copies (see safe_copy_async)
+copy_executor = None
+copy_futures = dict()
+
+# DICOM header tags needed by dcm_info (PatientSex, PatientAge)
+DCM_INFO_TAGS = [Tag(0x0010, 0x0040), Tag(0x0010, 0x1010)]
+
+# DICOM tags needed to identify the series of each file (see series_crcs)
+DCM_SERIES_TAGS = [Tag(0x0008, 0x103E), Tag(0x0020, 0x000E)]
+
+# Any BIDS or ReproIn '<key>-' string within a BIDS-like filename
+BIDS_KEY_RE = re.compile(r'(func|fmap|anat|dwi|sub|ses|task|run|acq|dir|ce|rec|mod|echo|proc|part|suffix)-')
+
+
+def json_loads(data):
+    """
+    Decode JSON text or bytes, using orjson if available
+    Falls back to the json module for input orjson rejects (eg NaN), so results don't depend on orjson
+    :param data: bytes or str
+    :return: decoded object
+    """
+
+    if HAVE_ORJSON:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+
+    return json.loads(data)
+
+
+def json_dumps(obj):
+    """
+    Encode object as indented JSON bytes
+    Always uses the json module so that sidecars and the translator have the same format
+    whether or not orjson is installed (orjson only supports 2-space indents and no ASCII escaping)
+    :param obj: JSON serializable object
+    :return: bytes
+    """
+
+    return json.dumps(obj, indent=4, separators=(',', ':')).encode('utf-8')
+
+
+@lru_cache(maxsize=4096)
+def _read_json_cached(fname, mtime_ns, size, version):
+    """
+    Parse a JSON file, caching the result by filename, modification time, size
+    and write count (see invalidate_json) so that an unchanged sidecar is only parsed once per run
+    Sidecars are small, so read them unbuffered in a single call
+    """
+
+    with open(fname, 'rb', buffering=0) as fd:
+        return json_loads(fd.read())
 
 
 def read_json(fname):
@@ -41,9 +124,10 @@ def read_json(fname):
     """
 
     try:
-        fd = open(fname, 'r')
-        json_dict = json.load(fd)
-        fd.close()
+        st = os.stat(fname)
+        # Return a deep copy so that callers can modify the dictionary, including nested lists
+        # such as ImageType and IntendedFor, without corrupting the cache
+        json_dict = copy.deepcopy(_read_json_cached(fname, st.st_mtime_ns, st.st_size, json_versions.get(fname, 0)))
     except IOError:
         print('*** {}'.format(fname))
         print('*** JSON sidecar not found - returning empty dictionary')
@@ -56,7 +140,18 @@ def read_json(fname):
     return json_dict
 
 
-def write_json(fname, meta_dict, overwrite=False):
+def invalidate_json(fname):
+    """
+    Mark a JSON file as rewritten so that the next read_json parses it again
+    Needed because a rewrite of the same size can keep the same mtime on filesystems
+    with coarse timestamps
+    :param fname: str, JSON filename
+    """
+
+    json_versions[fname] = json_versions.get(fname, 0) + 1
+
+
+def write_json(fname, meta_dict, overwrite=False, existing=None):
     """
     Write a dictionary to a JSON file. Account for overwrite flag
     :param fname: string
@@ -65,25 +160,91 @@ def write_json(fname, meta_dict, overwrite=False):
         Dictionary
     :param overwrite: bool
         Overwrite flag
+    :param existing: set of str
+        Optional snapshot of existing files from list_existing_files (avoids a stat call)
     :return:
     """
 
     bname = os.path.basename(fname)
+    payload = None
 
-    if os.path.isfile(fname):
+    if file_exists(fname, existing):
         if overwrite:
-            print('    Overwriting previous %s' % bname)
-            create_file = True
+            # Skip rewriting a sidecar whose contents would be unchanged
+            payload = json_dumps(meta_dict)
+            if read_bytes(fname) == payload:
+                logger.debug('    Preserving unchanged %s', bname)
+                create_file = False
+            else:
+                logger.debug('    Overwriting previous %s', bname)
+                create_file = True
         else:
-            print('    Preserving previous %s' % bname)
+            logger.debug('    Preserving previous %s', bname)
             create_file = False
     else:
-        print('    Creating new %s' % bname)
+        logger.debug('    Creating new %s', bname)
         create_file = True
 
     if create_file:
-        with open(fname, 'w') as fd:
-            json.dump(meta_dict, fd, indent=4, separators=(',', ':'))
+        # Encode once and write in a single call
+        if payload is None:
+            payload = json_dumps(meta_dict)
+        with open(fname, 'wb') as fd:
+            fd.write(payload)
+        invalidate_json(fname)
+        if existing is not None:
+            existing.add(fname)
+
+
+def read_bytes(fname):
+    """
+    Read the raw contents of a file, returning None if it can't be read
+    :param fname: str
+    :return: bytes or None
+    """
+
+    try:
+        with open(fname, 'rb', buffering=0) as fd:
+            return fd.read()
+    except IOError:
+        return None
+
+
+def iter_files(dname, _visited=None):
+    """
+    Recursively yield file paths within a directory tree using os.scandir
+    :param dname: str, top level directory
+    :return: generator of str
+    """
+
+    # Directory symlinks are followed (so files reached through them are listed under the
+    # symlinked path), but a directory already open further up the current branch
+    # (keyed by device and inode) is skipped so symlink cycles cannot recurse forever
+    if _visited is None:
+        _visited = set()
+
+    # Silently skip unreadable or missing directories
+    try:
+        st = os.stat(dname)
+        it = os.scandir(dname)
+    except OSError:
+        return
+
+    key = (st.st_dev, st.st_ino)
+    if key in _visited:
+        it.close()
+        return
+    _visited.add(key)
+
+    try:
+        with it:
+            for entry in it:
+                if entry.is_dir():
+                    yield from iter_files(entry.path, _visited)
+                elif entry.is_file():
+                    yield entry.path
+    finally:
+        _visited.discard(key)
 
 
 def dcm_info(dcm_dir):
@@ -96,27 +257,25 @@ def dcm_info(dcm_dir):
     """
 
     # Init the DICOM structure
-    ds = []
+    ds = None
 
     # Init the subject info dictionary
     info_dict = dict()
 
-    # Walk through dcm_dir looking for valid DICOM files
-    for subdir, dirs, files in os.walk(dcm_dir):
-
-        for file in files:
+    # Search dcm_dir for the first valid DICOM file
+    # Only the patient sex and age tags are needed, so skip the pixel data
+    for fpath in iter_files(dcm_dir):
 
-            try:
-                ds = pydicom.dcmread(os.path.join(subdir, file))
-            except Exception as err:
-                # Silently skip problem files in DICOM directory
-                continue
+        try:
+            ds = pydicom.dcmread(fpath, stop_before_pixels=True, specific_tags=DCM_INFO_TAGS)
+        except Exception as err:
+            # Silently skip problem files in DICOM directory
+            continue
 
-            # Break out if valid DICOM read
-            if ds:
-                break
+        # Stop searching once a valid DICOM has been read
+        break
 
-    if ds:
+    if ds is not None:
 
         # Fill dictionary
         # Note that DICOM anonymization tools sometimes clear these fields
@@ -140,6 +299,41 @@ def dcm_info(dcm_dir):
     return info_dict
 
 
+def series_crcs(dcm_dir, ser_descs):
+    """
+    Find the dcm2niix series CRCs (see dcm2niix -n) of DICOM series with given descriptions
+    The CRC is the CRC32 of the DICOM SeriesInstanceUID
+
+    :param dcm_dir: directory containing all DICOM files or DICOM subfolders
+    :param ser_descs: set of str, series descriptions with spaces replaced by underscores
+    :return crcs: list of int, sorted series CRCs
+    """
+
+    crcs = set()
+    seen_uids = set()
+
+    # Only the series tags are needed, so skip the pixel data
+    for fpath in iter_files(dcm_dir):
+
+        try:
+            ds = pydicom.dcmread(fpath, stop_before_pixels=True, specific_tags=DCM_SERIES_TAGS)
+        except Exception:
+            # Silently skip problem files in DICOM directory
+            continue
+
+        uid = str(ds.get('SeriesInstanceUID', ''))
+        if not uid or uid in seen_uids:
+            continue
+        seen_uids.add(uid)
+
+        # Match series description as it appears in the protocol translator
+        ser_desc = str(ds.get('SeriesDescription', '')).replace(' ', '_')
+        if ser_desc in ser_descs:
+            crcs.add(zlib.crc32(uid.encode('utf-8')) & 0xffffffff)
+
+    return sorted(crcs)
+
+
 def parse_dcm2niix_fname(fname):
     """
     Parse dcm2niix filename into values
@@ -160,6 +354,16 @@ def parse_dcm2niix_fname(fname):
     :return info: dict
     """
 
+    # Return a copy so that callers can modify the dictionary without corrupting the cache
+    return dict(_parse_dcm2niix_fname(fname))
+
+
+@lru_cache(maxsize=8192)
+def _parse_dcm2niix_fname(fname):
+    """
+    Cached dcm2niix filename parser (see parse_dcm2niix_fname)
+    """
+
     # Create info dictionary
     info = dict()
 
@@ -206,6 +410,18 @@ def parse_bids_fname_keyvals(fname):
         Containing directory
     """
 
+    # Return a copy so that callers can modify the dictionary without corrupting the cache
+    bids_keys, dname = _parse_bids_fname_keyvals(fname)
+
+    return dict(bids_keys), dname
+
+
+@lru_cache(maxsize=8192)
+def _parse_bids_fname_keyvals(fname):
+    """
+    Cached BIDS-like filename parser (see parse_bids_fname_keyvals)
+    """
+
     # Split filename into containing directory and base name
     dname = os.path.dirname(fname)
     bids_stub = os.path.basename(fname)
@@ -233,11 +449,15 @@ def parse_bids_fname_keyvals(fname):
 
     # Extract base filename and strip up to two extensions
     # Accounts for both '.nii' and '.nii.gz' variants
-    bids_stub, ext1 = os.path.splitext(bids_stub)
-    bids_stub, ext2 = os.path.splitext(bids_stub)
+    if bids_stub.endswith('.nii.gz'):
+        bids_stub, ext = bids_stub[:-7], '.nii.gz'
+    else:
+        bids_stub, ext1 = os.path.splitext(bids_stub)
+        bids_stub, ext2 = os.path.splitext(bids_stub)
+        ext = ext2 + ext1
 
     # Remember full extension
-    bids_keys['extension'] = ext2 + ext1
+    bids_keys['extension'] = ext
 
     # Check for recon variants keys at end of BIDS stub string
     # These may have a leading '_' or ' ' eg 'acq-mez_T1w RMS' and 'task-rest_bold_SBRef'
@@ -279,46 +499,23 @@ def parse_bids_fname_keyvals(fname):
     # Divide filename into keys and values
     # Value segments are delimited by '<key>-' strings
 
-    key_name = []
-    val_start = []
-    key_start = []
-
-    # Search for any valid keys in filename
-    # Record key and value start indices within string
-    for key in bids_keys:
-
-        key_str = key + '-'
-
-        i0 = bids_stub.find(key_str)
-        if i0 > -1:
-            i1 = i0 + len(key_str)
-            key_name.append(key)
-            key_start.append(i0)
-            val_start.append(i1)
-
-    # Convert lists to numpy arrays
-    key_name = np.array(key_name)
-    key_start = np.array(key_start)
-    val_start = np.array(val_start)
-
-    # Sort keys by position in filename
-    key_order = np.argsort(key_start)
-    key_name_sorted = key_name[key_order]
-    val_start_sorted = val_start[key_order]
-    val_end_sorted = key_start[np.roll(key_order, -1)] - 1
+    # Find the first occurrence of each valid key in a single regex scan
+    # Matches are returned in order of position within the filename
+    key_spans = dict()
+    for m in BIDS_KEY_RE.finditer(bids_stub):
+        key_spans.setdefault(m.group(1), (m.start(), m.end()))
+    key_spans = list(key_spans.items())
 
     # Fill BIDS key-value dictionary
-    for kc in range(len(key_name_sorted)):
-
-        kname = key_name_sorted[kc]
-        vstart = val_start_sorted[kc]
-        vend = val_end_sorted[kc]
+    for kc, (kname, (_, vstart)) in enumerate(key_spans):
 
-        # Catch negative vend (only happens for final key-value without suffix)
-        if vend < 0:
-            bids_keys[kname] = bids_stub[vstart:]
-        else:
+        if kc + 1 < len(key_spans):
+            # Value ends at the delimiter preceding the next key
+            vend = key_spans[kc + 1][1][0] - 1
             bids_keys[kname] = bids_stub[vstart:vend]
+        else:
+            # Final key-value runs to the end of the stub
+            bids_keys[kname] = bids_stub[vstart:]
 
     # Tidy up Siemens recon extensions
     if 'SBRef' in recon_key:
@@ -342,40 +539,177 @@ def parse_bids_fname_keyvals(fname):
 def safe_mkdir(dname):
     """
     Safely create a directory path
+    Directories already created or found by this process are remembered and skipped
     :param dname: string
     :return:
     """
 
-    if not os.path.isdir(dname):
-        os.makedirs(dname, exist_ok=True)
+    if dname not in created_dirs:
+        if not os.path.isdir(dname):
+            os.makedirs(dname, exist_ok=True)
+        created_dirs.add(dname)
 
 
-def safe_copy(fname1, fname2, overwrite=False):
+def safe_copy(fname1, fname2, overwrite=False, existing=None):
     """
     Copy file accounting for overwrite flag
     :param fname1: str
     :param fname2: str
     :param overwrite: bool
+    :param existing: set of str
+        Optional snapshot of existing files from list_existing_files (avoids a stat call)
     :return:
     """
 
+    if claim_copy(fname1, fname2, overwrite, existing):
+        fast_copy(fname1, fname2)
+
+
+def claim_copy(fname1, fname2, overwrite=False, existing=None):
+    """
+    Decide whether fname1 should be copied to fname2 and record the destination
+    in the existing snapshot so later decisions see it
+    :param fname1: str
+    :param fname2: str
+    :param overwrite: bool
+    :param existing: set of str
+        Optional snapshot of existing files from list_existing_files (avoids a stat call)
+    :return: bool
+        True if the copy should go ahead
+    """
+
     bname1, bname2 = os.path.basename(fname1), os.path.basename(fname2)
 
-    if os.path.isfile(fname2):
+    if file_exists(fname2, existing):
         if overwrite:
-            print('    Copying %s to %s (overwrite)' % (bname1, bname2))
+            logger.debug('    Copying %s to %s (overwrite)', bname1, bname2)
             create_file = True
         else:
-            print('    Preserving previous %s' % bname2)
+            logger.debug('    Preserving previous %s', bname2)
             create_file = False
     else:
-        print('    Copying %s to %s' % (bname1, bname2))
+        logger.debug('    Copying %s to %s', bname1, bname2)
         create_file = True
 
-    if create_file:
+    if create_file and existing is not None:
+        existing.add(fname2)
+
+    return create_file
+
+
+def safe_copy_async(fname1, fname2, overwrite=False, existing=None):
+    """
+    Copy file accounting for overwrite flag, running the copy itself in a background
+    thread pool so that copies overlap with each other and with sidecar writes.
+    The overwrite decision is made here, in the calling thread.
+    Call wait_for_copies before relying on the copied files
+    :param fname1: str
+    :param fname2: str
+    :param overwrite: bool
+    :param existing: set of str
+        Optional snapshot of existing files from list_existing_files (avoids a stat call)
+    :return:
+    """
+
+    global copy_executor
+
+    if not claim_copy(fname1, fname2, overwrite, existing):
+        return
+
+    if IO_THREADS < 2:
+        fast_copy(fname1, fname2)
+        return
+
+    if copy_executor is None:
+        copy_executor = ThreadPoolExecutor(max_workers=IO_THREADS)
+
+    # Let any pending copy to the same destination finish before replacing it
+    if fname2 in copy_futures:
+        copy_futures.pop(fname2).result()
+
+    copy_futures[fname2] = copy_executor.submit(fast_copy, fname1, fname2)
+
+
+def wait_for_copies():
+    """
+    Wait for all queued background copies to finish, re-raising any copy error
+    """
+
+    global copy_futures
+
+    futures, copy_futures = copy_futures, dict()
+    for future in futures.values():
+        future.result()
+
+
+def fast_copy(fname1, fname2):
+    """
+    Copy a file without passing the data through Python buffers where possible
+    - in-kernel copy with os.copy_file_range (reflink on btrfs/XFS)
+    - otherwise fall back to shutil.copy
+    Outputs are never hard linked to the source, since dcm2niix reruns rewrite work files in place
+    :param fname1: str
+    :param fname2: str
+    :return:
+    """
+
+    # Remove any previous destination file first. Outputs from older versions may be hard links
+    # to the source and must not be truncated in place
+    if os.path.lexists(fname2):
+        os.remove(fname2)
+
+    try:
+        with open(fname1, 'rb') as fd1, open(fname2, 'wb') as fd2:
+            remaining = os.fstat(fd1.fileno()).st_size
+            while remaining > 0:
+                n_copied = os.copy_file_range(fd1.fileno(), fd2.fileno(), remaining)
+                if n_copied == 0:
+                    break
+                remaining -= n_copied
+        if remaining > 0:
+            raise OSError('copy_file_range incomplete')
+        shutil.copymode(fname1, fname2)
+    except (AttributeError, OSError):
         shutil.copy(fname1, fname2)
 
 
+def list_existing_files(dname):
+    """
+    Snapshot the files within the purpose subdirectories (anat, func, etc) of a BIDS
+    subject or session directory with a single scandir pass per directory
+
+    :param dname: str
+        BIDS subject or session directory
+    :return: set of str
+        Full paths of existing files
+    """
+
+    existing = set()
+
+    if os.path.isdir(dname):
+        with os.scandir(dname) as it:
+            for purpose_entry in it:
+                if purpose_entry.is_dir():
+                    with os.scandir(purpose_entry.path) as pit:
+                        existing.update(e.path for e in pit if e.is_file())
+
+    return existing
+
+
+def file_exists(fname, existing=None):
+    """
+    Check for an existing file, using a snapshot from list_existing_files if provided
+    :param fname: str
+    :param existing: set of str or None
+    :return: bool
+    """
+
+    if existing is None:
+        return os.path.isfile(fname)
+    else:
+        return fname in existing
+
+
 def create_file_if_missing(filename, content):
     """
     Create file if missing, so we do not override any possibly introduced changes
@@ -399,6 +733,7 @@ def create_file_if_missing(filename, content):
     return True
 
 
+@lru_cache(maxsize=8192)
 def strip_extensions(fname):
     """
     Remove one or more extensions from a filename
@@ -406,6 +741,10 @@ def strip_extensions(fname):
     :return:
     """
 
+    # Fast path for the most common compressed Nifti extension
+    if fname.endswith('.nii.gz'):
+        return fname[:-7], '.nii.gz'
+
     fstub, fext = os.path.splitext(fname)
     if fext == '.gz':
         fstub, fext2 = os.path.splitext(fstub)
@@ -416,12 +755,18 @@ def strip_extensions(fname):
 def nii_to_json(nii_fname, nii_ext):
     """
     Replace Nifti extension ('.nii.gz' or '.nii') with '.json'
+    Either Nifti extension is recognized regardless of nii_ext
 
     :param nii_fname:
+    :param nii_ext: str, expected Nifti extension
     :return: json_fname
     """
-    if nii_ext in nii_fname:
-        json_fname = nii_fname.replace(nii_ext, '.json')
+
+    # Rewrite the trailing extension only
+    if nii_fname.endswith('.nii.gz'):
+        json_fname = nii_fname[:-7] + '.json'
+    elif nii_fname.endswith('.nii'):
+        json_fname = nii_fname[:-4] + '.json'
     else:
         print('* Unknown extension for %s' % nii_fname)
         json_fname = nii_fname + '.json'
@@ -22,17 +22,56 @@ SOFTWARE.
 
 import os
 import sys
-import numpy as np
+import re
+import logging
+from collections import Counter
 
 from . import fmaps
 from . import dcm2niix as d2n
 from .io import (read_json,
                  write_json,
                  parse_bids_fname_keyvals,
-                 safe_copy,
+                 safe_copy_async,
                  create_file_if_missing,
+                 file_exists,
+                 strip_extensions,
                  nii_to_json)
 
+# Per-series progress messages are logged at INFO level (see --quiet)
+# and per-file messages at DEBUG level (see --verbose)
+logger = logging.getLogger(__name__)
+
+# Known participant IDs for each participants.tsv, with the file mtime and size when last read or written
+participants_cache = dict()
+
+# Trailing BIDS suffix of a filename (eg '_bold' in '.../sub-01_task-rest_bold.nii.gz')
+BIDS_SUFFIX_RE = re.compile(r'_[A-Za-z0-9]+(?=(?:\.[^./\\]+)*$)')
+
+# Siemens recon variants appended to the suffix by dcm2niix series descriptions
+RECON_TAILS = ('SBRef', 'RMS')
+
+# Correct filename key order from BIDS spec (see bids_keys_to_filename)
+BIDS_KEY_ORDER = ('sub', 'ses', 'task', 'acq', 'dir', 'rec', 'run', 'echo', 'part')
+
+# Translation table deleting characters not allowed in BIDS key values (see bids_legalize_keys)
+BIDS_BAD_CHARS_TABLE = str.maketrans('', '', '-_')
+
+# List of possible suffices for each BIDS type
+BIDS_TYPES = {
+    'func': ['bold', 'sbref'],
+    'anat': ['T1w', 'T2w', 'PDw', 'T2starw', 'FLAIR',
+             'defacemask', 'MEGRE', 'MESE', 'VFA', 'IRT1',
+             'MP2RAGE', 'MPM', 'MTS', 'MTR'],
+    'fmap': ['gre', 'epi'],
+    'dwi': ['dwi']
+}
+
+# BIDS type directory for each suffix (see auto_translate)
+SUFFIX_TO_BIDS_TYPE = {suffix: bids_type for bids_type, suffixes in BIDS_TYPES.items() for suffix in suffixes}
+
+# Column header for template events files
+EVENTS_HEADER = b'onset\tduration\ttrial_type\tresponse_time\n'
+
 
 def add_participant_record(studydir, subject, age, sex):
     """
@@ -44,24 +83,98 @@ def add_participant_record(studydir, subject, age, sex):
     :return:
     """
 
-    participants_tsv = os.path.join(studydir, 'participants.tsv')
-    participant_id = 'sub-%s' % subject
+    with ParticipantsWriter(studydir) as participants:
+        participants.add(subject, age, sex)
 
-    if not create_file_if_missing(participants_tsv, '\t'.join(['participant_id', 'age', 'sex', 'handedness']) + '\n'):
 
-        # Check if subject record already exists
-        with open(participants_tsv) as f:
-            f.readline()
-            known_subjects = {this_line.split('\t')[0] for this_line in f.readlines()}
+class ParticipantsWriter:
+    """
+    Add participant records to participants.tsv, keeping the file open across a subject loop
+    Existing participant IDs are skipped as in add_participant_record
+
+    with ParticipantsWriter(studydir) as participants:
+        for ...:
+            participants.add(subject, age, sex)
+    """
+
+    def __init__(self, studydir):
+        """
+        :param studydir: str, BIDS dataset directory containing participants.tsv
+        """
 
-        if participant_id in known_subjects:
+        self.participants_tsv = os.path.join(studydir, 'participants.tsv')
+        self.known_subjects = None
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, subject, age, sex):
+        """
+        Append a participant record unless the subject ID is already listed
+        The file is opened on the first call, so an unused writer leaves participants.tsv untouched
+
+        :param subject: str, subject ID without 'sub-' prefix
+        :param age: str, DICOM patient age (eg '031Y')
+        :param sex: str, DICOM patient sex
+        :return:
+        """
+
+        participant_id = 'sub-%s' % subject
+
+        if self.known_subjects is None:
+            self.known_subjects = self._read_known_subjects()
+
+        if participant_id in self.known_subjects:
             return
 
-    # Add a new participant
-    with open(participants_tsv, 'a') as f:
-        f.write(
+        # Add a new participant
+        if self.f is None:
+            self.f = open(self.participants_tsv, 'a')
+
+        self.f.write(
             '\t'.join(map(str, [participant_id, age.lstrip('0').rstrip('Y') if age else 'N/A', sex, 'left'])) + '\n')
 
+        self.known_subjects.add(participant_id)
+
+    def close(self):
+        """
+        Close participants.tsv and remember the known subject IDs for later writers
+        """
+
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+        if self.known_subjects is not None:
+            st = os.stat(self.participants_tsv)
+            participants_cache[self.participants_tsv] = (st.st_mtime_ns, st.st_size, self.known_subjects)
+
+    def _read_known_subjects(self):
+        """
+        Participant IDs already in participants.tsv, creating the file with a header if missing
+        """
+
+        participants_tsv = self.participants_tsv
+
+        if create_file_if_missing(participants_tsv, '\t'.join(['participant_id', 'age', 'sex', 'handedness']) + '\n'):
+            return set()
+
+        # Reuse the known subject IDs unless the file has changed since it was last read or written
+        st = os.stat(participants_tsv)
+        cached = participants_cache.get(participants_tsv)
+
+        if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+
+        # Check if subject record already exists
+        with open(participants_tsv) as f:
+            f.readline()
+            return {this_line.partition('\t')[0] for this_line in f}
+
 
 def purpose_handling(bids_meta,
                      bids_purpose,
@@ -72,7 +185,8 @@ def purpose_handling(bids_meta,
                      bids_json_fname,
                      key_flags,
                      overwrite,
-                     nii_ext):
+                     nii_ext,
+                     existing=None):
     """
     Special handling for each image purpose (func, anat, fmap, dwi, etc)
 
@@ -93,6 +207,10 @@ def purpose_handling(bids_meta,
         dictionary of filename key flags
     :param overwrite: bool
         Overwrite flag for sub-* output
+    :param nii_ext: str
+        Nifti image extension accounting for compression (*.nii or *.nii.gz)
+    :param existing: set of str
+        Optional snapshot of existing files in the BIDS output directory
     :return:
     """
 
@@ -103,27 +221,28 @@ def purpose_handling(bids_meta,
     bids_bvec_fname = []
 
     # Extract some useful fields from the BIDS metadata
+    # bids_meta is the parsed work JSON sidecar and is shared with the handle_* helpers
     scan_seq = bids_meta['ScanningSequence']
 
     if bids_purpose == 'func':
 
         if 'EP' in scan_seq:
 
-            print('    EPI detected')
+            logger.info('    EPI detected')
 
             # Handle multiecho EPI (echo-*). Modify bids fnames as needed
             bids_nii_fname, bids_json_fname = d2n.handle_multiecho(
-                work_json_fname, bids_json_fname, key_flags['Echo'], nii_ext)
+                work_json_fname, bids_json_fname, key_flags['Echo'], nii_ext, bids_meta)
 
             # Handle complex-valued EPI (part-*). Modify bids fnames as needed
             bids_nii_fname, bids_json_fname = d2n.handle_complex(
                 work_json_fname, bids_json_fname, key_flags['Part'], nii_ext)
 
             # Handle task info
-            create_events_template(bids_nii_fname, overwrite, nii_ext)
+            create_events_template(bids_nii_fname, overwrite, nii_ext, existing)
 
             # Add taskname to BIDS JSON sidecar
-            bids_keys = parse_bids_fname_keyvals(bids_nii_fname)
+            bids_keys, _ = parse_bids_fname_keyvals(bids_nii_fname)
             if 'task' in bids_keys:
                 bids_meta['TaskName'] = bids_keys['task']
             else:
@@ -138,19 +257,19 @@ def purpose_handling(bids_meta,
         # Check for GRE vs SE-EPI fieldmap images
         # GRE will have a 'GR' sequence, SE-EPI will have 'EP'
 
-        print('    Identifying fieldmap image type')
+        logger.info('    Identifying fieldmap image type')
 
         if 'GR' in scan_seq:
 
-            print('    Gradient echo fieldmap detected')
-            print('    Identifying magnitude and phase images')
+            logger.info('    Gradient echo fieldmap detected')
+            logger.info('    Identifying magnitude and phase images')
 
             # Update BIDS filenames according to BIDS Fieldmap Case (1 or 2 - see specification)
             bids_nii_fname, bids_json_fname = fmaps.handle_fmap_case(work_json_fname, bids_nii_fname, bids_json_fname)
 
         elif 'EP' in scan_seq:
 
-            print('    EPI fieldmap detected')
+            logger.info('    EPI fieldmap detected')
 
             # Handle complex-valued EPI (part-*). Modify bids fnames as needed
             bids_nii_fname, bids_json_fname = d2n.handle_complex(
@@ -158,18 +277,18 @@ def purpose_handling(bids_meta,
 
         else:
 
-            print('    Unrecognized fieldmap detected')
-            print('    Simply copying image and sidecar to fmap directory')
+            logger.info('    Unrecognized fieldmap detected')
+            logger.info('    Simply copying image and sidecar to fmap directory')
 
     elif bids_purpose == 'anat':
 
         if 'GR' in scan_seq and 'IR' in scan_seq:
 
-            print('    IR-prepared GRE detected - likely T1w MPRAGE or MEMPRAGE')
+            logger.info('    IR-prepared GRE detected - likely T1w MPRAGE or MEMPRAGE')
 
             # Handle MEMPRAGE. Modify bids fnames as needed
             bids_nii_fname, bids_json_fname = d2n.handle_multiecho(
-                work_json_fname, bids_json_fname, key_flags['Echo'], nii_ext)
+                work_json_fname, bids_json_fname, key_flags['Echo'], nii_ext, bids_meta)
 
             # Handle complex-valued MEMPRAGE. Modify bids fnames as needed
             bids_nii_fname, bids_json_fname = d2n.handle_complex(
@@ -177,41 +296,45 @@ def purpose_handling(bids_meta,
 
             # Handle biased and unbiased (NORM) reconstructions
             bids_nii_fname, bids_json_fname = d2n.handle_bias_recon(
-                work_json_fname, bids_json_fname, key_flags['Recon'], nii_ext)
+                work_json_fname, bids_json_fname, key_flags['Recon'], nii_ext, bids_meta)
 
         elif 'SE' in scan_seq:
 
-            print('    Spin echo detected - likely T1w or T2w anatomic image')
+            logger.info('    Spin echo detected - likely T1w or T2w anatomic image')
             bids_nii_fname, bids_json_fname = d2n.handle_bias_recon(
-                work_json_fname, bids_json_fname, key_flags['Recon'], nii_ext)
+                work_json_fname, bids_json_fname, key_flags['Recon'], nii_ext, bids_meta)
 
         elif 'GR' in scan_seq:
 
-            print('    Gradient echo detected')
+            logger.info('    Gradient echo detected')
 
     elif bids_purpose == 'dwi':
 
-        # Fill DWI bval and bvec working and source filenames
-        # Non-empty filenames trigger the copy below
-        work_bval_fname = str(work_json_fname.replace('.json', '.bval'))
-        bids_bval_fname = str(bids_json_fname.replace('dwi.json', 'dwi.bval'))
-        work_bvec_fname = str(work_json_fname.replace('.json', '.bvec'))
-        bids_bvec_fname = str(bids_json_fname.replace('dwi.json', 'dwi.bvec'))
+        # Fill DWI bval and bvec working and source filenames from the JSON sidecar stems
+        # Non-empty filenames trigger the copy below (dwi suffix only, not sbref etc)
+        work_stem = str(work_json_fname)[:-len('.json')]
+        bids_stem = str(bids_json_fname)[:-len('.json')]
+        if bids_stem.endswith('dwi'):
+            work_bval_fname = work_stem + '.bval'
+            bids_bval_fname = bids_stem + '.bval'
+            work_bvec_fname = work_stem + '.bvec'
+            bids_bvec_fname = bids_stem + '.bvec'
 
     # Populate BIDS source directory with Nifti images, JSON and DWI sidecars
-    print('  Populating BIDS source directory')
+    logger.info('  Populating BIDS source directory')
 
+    # File copies run in the background and are waited for at the end of the session (see organize_series)
     if bids_nii_fname:
-        safe_copy(work_nii_fname, str(bids_nii_fname), overwrite)
+        safe_copy_async(work_nii_fname, str(bids_nii_fname), overwrite, existing)
 
     if bids_json_fname:
-        write_json(bids_json_fname, bids_meta, overwrite)
+        write_json(bids_json_fname, bids_meta, overwrite, existing)
 
     if bids_bval_fname:
-        safe_copy(work_bval_fname, bids_bval_fname, overwrite)
+        safe_copy_async(work_bval_fname, bids_bval_fname, overwrite, existing)
 
     if bids_bvec_fname:
-        safe_copy(work_bvec_fname, bids_bvec_fname, overwrite)
+        safe_copy_async(work_bvec_fname, bids_bvec_fname, overwrite, existing)
 
 
 def add_run_number(bids_stub, run_no):
@@ -224,6 +347,11 @@ def add_run_number(bids_stub, run_no):
     :return: new_bids_stub, str
     """
 
+    # Singular series without a run- key are returned unchanged without parsing the stub
+    # A run key can only be parsed from the stub if it contains 'run-'
+    if run_no < 1 and 'run-' not in bids_stub:
+        return bids_stub
+
     # Default returns original stub unchanged
     new_bids_stub = bids_stub
 
@@ -233,7 +361,7 @@ def add_run_number(bids_stub, run_no):
     if 'run' in bids_keys.keys():
 
         # Preserve existing run-%d value in suffix
-        print('  * BIDS suffix already contains run number - skipping')
+        logger.info('  * BIDS suffix already contains run number - skipping')
 
     else:
 
@@ -256,7 +384,7 @@ def add_bids_key(bids_json_fname, key_name, key_value, nii_ext):
 
     if key_name in keys:
 
-        print(f'  * Key {key_name} already present in filename - skipping')
+        logger.info('  * Key %s already present in filename - skipping', key_name)
         new_bids_json_fname = bids_json_fname
 
     else:
@@ -268,7 +396,7 @@ def add_bids_key(bids_json_fname, key_name, key_value, nii_ext):
         new_bids_json_fname = bids_keys_to_filename(keys, dname)
 
     # Construct associated Nifti filename
-    new_bids_nii_fname = new_bids_json_fname.replace('.json', nii_ext)
+    new_bids_nii_fname = new_bids_json_fname[:-len('.json')] + nii_ext
 
     return new_bids_nii_fname, new_bids_json_fname
 
@@ -299,29 +427,20 @@ def bids_keys_to_filename(keys, dname):
     - key dictionary must include suffix and extension
     """
 
-    # Correct key order from BIDS spec
-    key_order = ['sub', 'ses', 'task', 'acq', 'dir', 'rec', 'run', 'echo', 'part']
+    # Collect key-value pairs in correct order, followed by the pulse sequence suffix (if any)
+    parts = [f"{key}-{keys[key]}" for key in BIDS_KEY_ORDER if key in keys]
+    if keys.get('suffix'):
+        parts.append(keys['suffix'])
 
-    # Init with the containing directory and trailing file separator if dname provided
-    if dname:
-        bids_fname = dname + os.path.sep
-    else:
-        bids_fname = ''
+    bids_fname = '_'.join(parts)
 
-    # Construct BIDS filename from keys in correct order
-    for key in key_order:
-        if key in keys:
-            bids_fname += f"{key}-{keys[key]}_"
+    # Remove any trailing '_' left by the suffix
+    if bids_fname.endswith('_'):
+        bids_fname = bids_fname[:-1]
 
-    # Add final pulse sequence suffix and extension
-    if 'suffix' in keys:
-        if len(keys['suffix']) > 0:
-            bids_fname += keys['suffix']
-
-    # Remove final trailing '_' (no suffix case)
-    if len(bids_fname) > 0:
-        if bids_fname[-1] == '_':
-            bids_fname = bids_fname[:-1]
+    # Prepend the containing directory and file separator if dname provided
+    if dname:
+        bids_fname = dname + os.path.sep + bids_fname
 
     if 'extension' in keys:
         bids_fname += keys['extension']
@@ -334,13 +453,8 @@ def bids_legalize_keys(keys):
     Scrub illegal characters from BIDS keys
     """
 
-    bad_chars = ['-', '_']
-
-    for key in keys:
-        value = keys[key]
-        for bc in bad_chars:
-            value = value.replace(bc, '')
-        keys[key] = value
+    for key, value in keys.items():
+        keys[key] = value.translate(BIDS_BAD_CHARS_TABLE)
 
     return keys
 
@@ -362,70 +476,48 @@ def auto_run_no(d2n_nii_list, prot_dict):
         dcm2niix output Nifti filename list
     :param prot_dict: dictionary
         Protocol translation dictionary
-    :return: run_num, array of int
+    :return: run_no, list of int
     """
 
-    # Construct list of series descriptions and original numbers from file names
-    series_id_list = []
-
-    # Loop over all
+    # Collect series description, echo number and recon type from each JSON sidecar
+    series_info = []
     for nii_fname in d2n_nii_list:
-
-        # Load JSON sidecar for this Nifti image
-        json_fname = nii_to_json(nii_fname, '.nii.gz')
-        bids_info = read_json(json_fname)
-
-        ser_desc = bids_info['SeriesDescription'].replace(' ', '_')
-        if 'EchoNumber' in bids_info.keys():
-            echo_no = bids_info['EchoNumber']
-        else:
-            echo_no = 1
-        recon_type = '-'.join(bids_info['ImageType'])
-
-        if ser_desc in prot_dict:
-            _, bids_stub, _ = prot_dict[ser_desc]
-        else:
-            print('')
+        bids_info = read_json(nii_to_json(nii_fname, '.nii.gz'))
+        series_info.append((
+            bids_info['SeriesDescription'].replace(' ', '_'),
+            bids_info.get('EchoNumber', 1),
+            '-'.join(bids_info['ImageType'])
+        ))
+
+    # Check all series descriptions against the translator at once
+    missing_descs = sorted({ser_desc for ser_desc, _, _ in series_info} - prot_dict.keys())
+    if missing_descs:
+        print('')
+        for ser_desc in missing_descs:
             print('* Series description {} missing from code/Protocol_Translator.json'.format(ser_desc))
-            print('* Please use EXCLUDE_BIDS_Directory and EXCLUDE_BIDS_Name instead of deleting a series entry')
-            print('* Exiting')
-            sys.exit(1)
-
-        # Construct a unique series identifier including echo number and suffix
-        series_id = f"{bids_stub}_ECHO{echo_no}_{recon_type}"
+        print('* Please use EXCLUDE_BIDS_Directory and EXCLUDE_BIDS_Name instead of deleting a series entry')
+        print('* Exiting')
+        sys.exit(1)
 
-        # Add to list
-        series_id_list.append(series_id)
+    # Construct a unique series identifier including echo number and suffix
+    series_id_list = [f"{prot_dict[ser_desc][1]}_ECHO{echo_no}_{recon_type}"
+                      for ser_desc, echo_no, recon_type in series_info]
 
-    # Find unique ser_desc entries using sets
-    unique_series_ids = set(series_id_list)
+    # Count occurrences of each series identifier
+    n_dups = Counter(series_id_list)
 
-    # Init vector of run numbers and max run numbers for each series
-    run_no = np.zeros(len(d2n_nii_list)).astype(int)
+    # Number duplicated series in list order in a single pass
+    # Singular series get run number -1 to indicate that run- should be dropped in BIDS filename creation
+    run_counts = dict()
+    run_no = []
 
-    # Loop over unique series descriptions
-    for unique_series_id in unique_series_ids:
-
-        # Count duplicates of unique description in description list
-        n_dup = series_id_list.count(unique_series_id)
-
-        if n_dup == 1:
-
-            # Replace run number of singular series with -1 to indicate
-            # that run- should be dropped in BIDS filename creation
-            run_no[series_id_list.index(unique_series_id)] = -1
+    for series_id in series_id_list:
 
+        if n_dups[series_id] == 1:
+            run_no.append(-1)
         else:
-
-            # Reset run counter
-            run_count = 0
-
-            # Loop over all series descriptions
-            for i, desc in enumerate(series_id_list):
-
-                if desc == unique_series_id:
-                    run_count += 1
-                    run_no[i] = run_count
+            run_counts[series_id] = run_counts.get(series_id, 0) + 1
+            run_no.append(run_counts[series_id])
 
     return run_no
 
@@ -439,14 +531,25 @@ def replace_suffix(fname, new_contrast):
     :return: new_fname: str, modified BIDS filename
     """
 
-    bids_keys, dname = parse_bids_fname_keyvals(fname)
-    bids_keys['suffix'] = new_contrast
-    new_fname = bids_keys_to_filename(bids_keys, dname)
+    # Siemens recon tails (eg '_bold_SBRef', '_T1w RMS') are parsed as part of the suffix and other keys,
+    # so always rebuild those filenames (see parse_bids_fname_keyvals)
+    if strip_extensions(os.path.basename(fname))[0].endswith(RECON_TAILS):
+        n_subs = 0
+    else:
+        # Substitute the trailing suffix in place, leaving the rest of the filename untouched
+        new_fname, n_subs = BIDS_SUFFIX_RE.subn('_' + new_contrast, fname, count=1)
+
+    if n_subs < 1:
+
+        # No simple suffix to replace (eg key-value pairs only) - rebuild filename with new suffix
+        bids_keys, dname = parse_bids_fname_keyvals(fname)
+        bids_keys['suffix'] = new_contrast
+        new_fname = bids_keys_to_filename(bids_keys, dname)
 
     return new_fname
 
 
-def create_events_template(bold_fname, overwrite, nii_ext):
+def create_events_template(bold_fname, overwrite, nii_ext, existing=None):
     """
     Create a template events file for a corresponding BOLD imaging file
     :param bold_fname: str
@@ -455,6 +558,8 @@ def create_events_template(bold_fname, overwrite, nii_ext):
         Overwrite flag
     :param nii_ext: str
         Nifti image extension accounting for compression (*.nii or *.nii.gz)
+    :param existing: set of str
+        Optional snapshot of existing files in the BIDS output directory
     """
 
     # Make specific to BOLD data to avoid overwriting with SBRef info
@@ -471,21 +576,26 @@ def create_events_template(bold_fname, overwrite, nii_ext):
         events_fname = bold_fname.replace("_bold" + nii_ext, "_events.tsv")
         events_bname = os.path.basename(events_fname)
 
-        if os.path.isfile(events_fname):
+        if file_exists(events_fname, existing):
             if overwrite:
-                print('  Overwriting previous %s' % events_bname)
+                logger.debug('  Overwriting previous %s', events_bname)
                 create_file = True
             else:
-                print('  Preserving previous %s' % events_bname)
+                logger.debug('  Preserving previous %s', events_bname)
                 create_file = False
         else:
-            print('  Creating %s' % events_fname)
+            logger.debug('  Creating %s', events_fname)
             create_file = True
 
         if create_file:
-            fd = open(events_fname, 'w')
-            fd.write('onset\tduration\ttrial_type\tresponse_time\n')
-            fd.close()
+            # Write fixed header bytes directly to the file descriptor
+            fd = os.open(events_fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, EVENTS_HEADER)
+            finally:
+                os.close(fd)
+            if existing is not None:
+                existing.add(events_fname)
 
 
 def auto_translate(info, json_fname=None):
@@ -502,16 +612,6 @@ def auto_translate(info, json_fname=None):
 
     ser_desc = info['SeriesDescription']
 
-    # List of possible suffices for each BIDS type
-    bids_types = {
-        'func': ['bold', 'sbref'],
-        'anat': ['T1w', 'T2w', 'PDw', 'T2starw', 'FLAIR',
-                 'defacemask', 'MEGRE', 'MESE', 'VFA', 'IRT1',
-                 'MP2RAGE', 'MPM', 'MTS', 'MTR'],
-        'fmap': ['gre', 'epi'],
-        'dwi': ['dwi']
-    }
-
     # Use BIDS filename parser on ReproIn-style series description
     # Returns any BIDS-like key values from series description string
     # The closer the series descriptions are to ReproIn specs, the
@@ -552,12 +652,8 @@ def auto_translate(info, json_fname=None):
 
     else:
 
-        # Infer BIDS type directory
-        bids_dir = 'anat'
-        for bids_type in bids_types:
-            if 'suffix' in bids_keys:
-                if bids_keys['suffix'] in bids_types[bids_type]:
-                    bids_dir = bids_type
+        # Infer BIDS type directory from suffix
+        bids_dir = SUFFIX_TO_BIDS_TYPE.get(bids_keys.get('suffix'), 'anat')
 
     # Scrub any illegal characters from BIDS key values (eg "-_.")
     bids_keys = bids_legalize_keys(bids_keys)
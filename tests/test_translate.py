@@ -0,0 +1,28 @@
+"""
+Tests for bidskit.translate filename helpers
+"""
+
+import os
+
+from bidskit import translate as tr
+
+
+def test_replace_suffix_simple():
+    fname = os.path.join('sub-01', 'fmap', 'sub-01_acq-gre_run-1_magnitude.nii.gz')
+    assert tr.replace_suffix(fname, 'phasediff') == os.path.join(
+        'sub-01', 'fmap', 'sub-01_acq-gre_run-1_phasediff.nii.gz')
+
+
+def test_replace_suffix_sbref_recon():
+    # Compound recon suffix is replaced as a whole, as in the baseline parse and rebuild
+    fname = os.path.join('sub-01', 'fmap', 'sub-01_task-rest_bold_SBRef.json')
+    assert tr.replace_suffix(fname, 'magnitude1') == os.path.join(
+        'sub-01', 'fmap', 'sub-01_task-rest_magnitude1.json')
+
+
+def test_replace_suffix_rms_recon():
+    assert tr.replace_suffix('sub-01_acq-mez_T1w RMS.json', 'magnitude1') == 'sub-01_acq-mezrms_magnitude1.json'
+
+
+def test_replace_suffix_no_suffix():
+    assert tr.replace_suffix('sub-01_acq-gre_run-2.json', 'phase1') == 'sub-01_acq-gre_run-2_phase1.json'